@@ -1,114 +1,359 @@
 from datetime import datetime, timedelta
-from backend import DataProcessor, TwitterAPI, config
-from pymongo import UpdateOne, MongoClient, ASCENDING
-from zappa.asynchronous import task
+from backend import DataProcessor, TwitterAPI, Database, Pipeline, Scheduler, Metrics, Retention, Rollups, Valet, config
+from backend.RequestState import RequestState
+from pymongo import UpdateOne
+from backend.Executor import task
+import uuid
+
+def fold_user_statistics(tweets):
+    '''
+        Folds a batch of tweets into one aggregate per author.
+        The result is a dict keyed by author_id that holds the tweet-count, the summed tweet_score and the hashtag-counts of the batch.
+        A hashtag is counted once per tweet, even when the tweet repeats it.
+    '''
+    authors = {}
+    for tweet in tweets:
+        if not 'author_id' in tweet:
+            continue
+
+        author = authors.setdefault(tweet['author_id'], {"count": 0, "last_used": tweet['created_at'], "score": 0, "hashtags": {}})
+        author['count'] += 1
+        author['last_used'] = max(author['last_used'], tweet['created_at'])
+        author['score'] += DataProcessor.calc_tweet_score(tweet)
+
+        if ('entities' in tweet) and ('hashtags' in tweet['entities']):
+            for tag in set(tag_data['tag'] for tag_data in tweet['entities']['hashtags']):
+                hashtag = author['hashtags'].setdefault(tag, {"count": 0, "last_used": tweet['created_at']})
+                hashtag['count'] += 1
+                hashtag['last_used'] = max(hashtag['last_used'], tweet['created_at'])
+
+    return authors
+
+def merge_named_counts(field, deltas):
+    '''
+        Returns an aggregation-expression that merges a list of {"name", "count", "last_used"}-deltas into the array "field" of a document.
+        Existing entries get their count increased, missing entries are appended.
+        The expression is evaluated by MongoDB, so concurrent updates of the same document can't overwrite each other's counts.
+    '''
+    existing = {"$ifNull": ["$" + field, []]}
+    deltas = {"$literal": deltas}
+
+    # the appended null is the result when no delta matches, $arrayElemAt of an empty array would be missing instead
+    matching_delta = {"$arrayElemAt": [{"$concatArrays": [{"$filter": {"input": deltas, "as": "d", "cond": {"$eq": ["$$d.name", "$$e.name"]}}}, [None]]}, 0]}
+    updated = {"$map": {"input": existing, "as": "e", "in":
+                {"$let": {"vars": {"d": matching_delta}, "in":
+                    {"$cond": [{"$eq": [{"$ifNull": ["$$d", None]}, None]},
+                               "$$e",
+                               {"name": "$$e.name", "count": {"$add": ["$$e.count", "$$d.count"]}, "last_used": {"$max": ["$$e.last_used", "$$d.last_used"]}}]}}}}}
+
+    added = {"$filter": {"input": deltas, "as": "d", "cond": {"$eq": [{"$in": ["$$d.name", {"$map": {"input": existing, "as": "e", "in": "$$e.name"}}]}, False]}}}
+
+    return {"$concatArrays": [updated, added]}
 
 @task
 def update_user_statistics(newest_id, oldest_id, request_name, db_details):
     '''
-        This function takes a tweet and will increase the statistics-count in the user-document.
+        This function takes the new tweets in the id-range and will increase the statistics-count in the user-documents.
         It is important to consider that this function should only be used with NEW tweets.
         For tweets that are downloaded multiple times, please use the function "update_existing_data()" to update the user-document.
+
+        All tweets of an author are folded into one aggregate, so the database receives one update per author and not per tweet.
+        The same batch is added to the rollups of the request (see Rollups). With config.rollups['embedded_user_statistics'] = False
+        the rollups replace the "requests"- and "hashtags"-arrays and the tweet_scores in the user-documents.
+
+        The tweets are claimed per request with one conditional update before they are counted: the request-name is added to "stats_counted"
+        and this run's id to "stats_runs", only where "stats_counted" doesn't contain the request yet. Only the tweets that carry the run's id are folded.
+        So every request counts a tweet it shares with other requests once, also when tasks over overlapping id-ranges run concurrently.
+        Tweets without author_id (e.g. a bare {id, requests}-stub of an older batch) are not claimed, they are counted once their fields are written.
+        Tweets that were counted before the claim was per request carry "user_stat_update" without "stats_counted", they are not counted again.
+        The "requests"-entry and the tweet_score of a user are per request, the "hashtags" of a user are not:
+        they only count the tweets this request claimed first, so a shared tweet adds its hashtags to the user once.
     '''
-    client = MongoClient(db_details['uri'])
-    database = client[db_details['database']]    
-    users = database[db_details['users_collection']]
-    tweets_collection = database[db_details['tweets_collection']]
+    with Metrics.timer('update_user_statistics', request_name) as timer:
+        database = Database.get_database(db_details)
+        users = database[db_details['users_collection']]
+        tweets_collection = database[db_details['tweets_collection']]
+
+        run_id = uuid.uuid4().hex
+        id_range = {'$gte': oldest_id, '$lte': newest_id}
+        not_counted = {'id': id_range, 'requests': request_name, 'stats_counted': {'$ne': request_name},
+                       '$or': [{'stats_counted': {'$exists': True}}, {'user_stat_update': {'$exists': False}}]}
+        claimed = tweets_collection.update_many(dict(not_counted, author_id={'$exists': True}),
+                                                {'$addToSet': {'stats_counted': request_name, 'stats_runs': run_id}})
+
+        stubs = tweets_collection.count_documents(dict(not_counted, author_id={'$exists': False}))
+        if stubs:
+            print(f"{stubs} tweets of {request_name} between {oldest_id} and {newest_id} have no fields yet, their statistics are updated later")
+
+        if not claimed.modified_count:
+            return
+
+        tweets = list(tweets_collection.find({'id': id_range, 'stats_runs': run_id},
+                                             projection={'_id': False, 'id': True, 'author_id': True, 'created_at': True, 'entities.hashtags': True, 'public_metrics': True, 'attachments.media_keys': True, 'stats_counted': True}))
+        timer.documents_read = len(tweets)
+
+        authors = fold_user_statistics(tweets)
+        if not authors:
+            return
+
+        if config.rollups['enabled']:
+            Rollups.update_rollups(request_name, tweets, authors, db_details)
+
+        ## the embedded statistics are only updated for authors that already have a user-document,
+        ## the rollups don't depend on the user-documents at all
+        user_bulk_request = []
+        if config.rollups['embedded_user_statistics']:
+            known_authors = set(user['id'] for user in users.find({"id": {"$in": list(authors)}}, projection={'_id': False, 'id': True}))
+            timer.documents_read += len(known_authors)
+
+            # $addToSet keeps the order of the claims, the first entry is the request that counted the tweet first
+            first_counted = fold_user_statistics([tweet for tweet in tweets if tweet['stats_counted'][0] == request_name])
+
+            keyvalue = 'tweet_scores.'+request_name
+            for author_id, author in authors.items():
+                if not author_id in known_authors:
+                    continue
+
+                updateset = {}
+                updateset['requests'] = merge_named_counts('requests', [{"name": request_name, "count": author['count'], "last_used": author['last_used']}])
+                hashtags = first_counted.get(author_id, {}).get('hashtags')
+                if hashtags:
+                    updateset['hashtags'] = merge_named_counts('hashtags', [{"name": tag, "count": hashtag['count'], "last_used": hashtag['last_used']} for tag, hashtag in hashtags.items()])
+                updateset[keyvalue] = {"$add": [{"$ifNull": ["$" + keyvalue, 0]}, author['score']]}
+
+                # create entry in the bulk_write-dicts that is used to do the database-transaction outside this loop
+                user_bulk_request.append(UpdateOne({ "id": author_id }, [{ "$set": updateset }]))
+
+        if user_bulk_request:
+            Database.bulk_write(users, user_bulk_request, ordered=False, request_name=request_name)
+
+@task
+def rebuild_rollups(request_name, db_details, batch_size=1000):
+    '''
+        Recreates the rollups of a request from its stored tweets, e.g. for requests that existed before the rollups.
+        Tweets that are added while the rebuild runs can be counted twice, so the request should not be pulled in the meantime.
+    '''
+    Rollups.clear(request_name, db_details)
 
-    tweets = tweets_collection.find({'id': {'$gte': oldest_id, '$lte': newest_id}, 'requests': request_name, 'user_stat_update': {'$exists': False}})
+    tweets_collection = Database.get_database(db_details)[db_details['tweets_collection']]
+    tweets = tweets_collection.find({'requests': request_name},
+                                    projection={'_id': False, 'id': True, 'author_id': True, 'created_at': True, 'entities.hashtags': True, 'public_metrics': True, 'attachments.media_keys': True},
+                                    batch_size=batch_size)
 
-    user_bulk_request = []
-    tweet_bulk_request = []
+    batch = []
     for tweet in tweets:
-        hashtags_udpated = set()
-        requests_udpated = set()
-        new_user_hashtags = list()
-        new_request_list = list()
-        updateset = {}
-
-        ## get current data of user from database
-        if 'author_id' in tweet:
-            user = users.find_one({ "id": tweet['author_id'] })      
-
-        ## step 1: add request_name to request-list
-        if user:
-
-            if 'requests' in user:
-                for request in user['requests']:
-                    if request['name'] == request_name:
-                        new_request_list.append({"name": request_name, "count": request['count'] + 1, "last_used": tweet['created_at']})
-                        requests_udpated.add(request['name'])
-                    else:
-                        new_request_list.append(request)
-                        requests_udpated.add(request['name'])
-
-                if not request_name in requests_udpated:
-                    new_request_list.append({"name": request_name, "count": 1, "last_used": tweet['created_at']})    
-            else:
-                new_request_list.append({"name": request_name, "count": 1, "last_used": tweet['created_at']})
-
-            # add data to the set-dict that we use to bulk-update later
-            updateset['requests'] = new_request_list
-
-            ## step 2: update hashtag statistics in user-document
-            if 'entities' in tweet:
-                if 'hashtags' in tweet['entities']:
-                    # when here, we have hashtags in the tweet-data
-
-                    for tag_data in tweet['entities']['hashtags']:
-                        # first, update all already existing hashtags that are assigned to a user
-                        if not tag_data['tag'] in hashtags_udpated:
-                            if 'hashtags' in user:
-                                for user_hashtag in user['hashtags']:
-                                    if user_hashtag['name'] == tag_data['tag']:
-                                        new_user_hashtags.append({"name": user_hashtag['name'], "count": user_hashtag['count'] + 1, "last_used": tweet['created_at']})
-                                        hashtags_udpated.add(tag_data['tag'])
-                                        break
-
-                        # second, assign new hashtags to user
-                        if not tag_data['tag'] in hashtags_udpated:
-                            new_user_hashtags.append({"name": tag_data['tag'], "count": 1, "last_used": tweet['created_at']})
-                            hashtags_udpated.add(tag_data['tag'])
-
-                    # add data to the set-dict that we use to bulk-update later
-                    updateset['hashtags'] = new_user_hashtags
-
-            ## step 3: update total tweet_score
-            score = DataProcessor.calc_tweet_score(tweet)
-            keyvalue = 'tweet_scores.'+request_name
+        batch.append(tweet)
+        if len(batch) == batch_size:
+            Rollups.update_rollups(request_name, batch, fold_user_statistics(batch), db_details)
+            batch = []
 
-            # create entry in the bulk_write-dicts that is used to do the database-transaction outside this loop
-            user_bulk_request.append(UpdateOne({ "id": tweet['author_id']}, { "$inc": { keyvalue: score }, "$set": updateset }))
-            tweet_bulk_request.append(UpdateOne({ "id": tweet['id']}, {"$set": {'user_stat_update': datetime.now()}}))
+    if batch:
+        Rollups.update_rollups(request_name, batch, fold_user_statistics(batch), db_details)
 
-    if user_bulk_request:
-        users.bulk_write(user_bulk_request)
+@task
+def apply_retention(request_info, db_details):
+    '''
+        Applies the retention-policy of the request (see Retention.policy()) to its expired tweets, in batches of policy['batch_size']:
+        mode "slim" compacts the tweets, mode "archive" moves them to the archive-collection and prunes the media they orphaned.
+        Tweets that other requests share are only compacted or archived when they expired for all of them, see Retention.plan_batch().
+        After policy['max_batches'] batches the rest is handed to a new invocation, like download_more_tweets() does with the pages.
+    '''
+    database = Database.get_database(db_details)
+    tweets_collection = database[db_details['tweets_collection']]
+    request_state = RequestState(database[db_details['request_collection']], request_info['name'], request_info['user'])
+
+    request = request_state.load(projection={'_id': False, 'retention': True, 'maintenance_delta': True})
+    if not request:
+        return
+
+    request_policy = Retention.policy(request)
+    if not request_policy['enabled']:
+        return
+
+    assert request_policy['mode'] in ('slim', 'archive'), 'The retention-mode should be "slim" or "archive".'
+
+    counts = {'compacted': 0, 'archived': 0, 'released': 0, 'retained': 0, 'media_pruned': 0}
+    more_batches = False
+    with Metrics.timer('retention', request_info['name']) as timer:
+        for batch in range(request_policy['max_batches']):
+            tweets = Retention.next_batch(tweets_collection, request_info['name'], request_policy)
+            if not tweets:
+                break
+
+            timer.documents_read += len(tweets)
+            policies = Retention.owner_policies(database, db_details, set(owner for tweet in tweets for owner in tweet['requests']))
+            policies[request_info['name']] = request_policy
+            plan = Retention.plan_batch(tweets, request_info['name'], policies)
+
+            for owner, tweet_ids in plan['release'].items():
+                counts['released'] += Retention.release_batch(tweets_collection, tweet_ids, owner)
+
+            if plan['retain']:
+                counts['retained'] += Retention.retain_batch(tweets_collection, plan['retain'], request_info['name'])
+
+            for compact_fields, tweet_ids in plan['compact'].items():
+                counts['compacted'] += Retention.compact_batch(tweets_collection, tweet_ids, compact_fields)
+
+            if plan['archive']:
+                # only the media of tweets that left the tweets-collection can be orphaned
+                media_keys = Retention.archive_batch(database, db_details, plan['archive'], request_info['name'])
+                counts['archived'] += len(plan['archive'])
+                if request_policy['prune_media']:
+                    counts['media_pruned'] += Retention.prune_media(database, db_details, media_keys)
+
+            more_batches = len(tweets) == request_policy['batch_size']
+
+        timer.documents_written = sum(counts.values())
+
+    request_state.inc({'retention_stats.' + key: value for key, value in counts.items()})
+    request_state.set({'last_retention_finished': datetime.now()})
+    Metrics.flush(request_state)
+    request_state.flush()
+
+    if more_batches:
+        apply_retention(request_info, db_details)
+
+def page_size(volume, last_pull):
+    '''
+        max_results for the first page of a pull: the tweets the query is expected to have since the last pull (volume-statistics),
+        with a margin and between config.paging['min_page_size'] and ['max_page_size']. The following pages always use the maximum.
+        Returns None without statistics, the parameters of the request are used as they are then.
+    '''
+    if (not config.paging['adaptive']) or (not volume) or (not 'tweets_per_hour' in volume):
+        return None
+
+    hours = max(0, (datetime.now() - last_pull).total_seconds() / 3600)
+    expected = int(volume['tweets_per_hour'] * hours * 1.2) + 1
+    return min(config.paging['max_page_size'], max(config.paging['min_page_size'], expected))
+
+def continuation_parameters(parameters):
+    if not config.paging['adaptive']:
+        return parameters
+
+    return TwitterAPI.with_page_size(parameters, config.paging['max_page_size'])
+
+def page_already_held(json_response, request_name, db_details):
+    '''
+        True when the request already holds every tweet of the page, the pages after it were downloaded by another chain of the request,
+        e.g. a concurrent pull with the same since_id. Don't ask for a page the chain itself may have written before (see resume_checkpoints()).
+    '''
+    if (not config.paging['early_stop']) or (not json_response.get('data')):
+        return False
+
+    tweet_ids = [tweet['id'] for tweet in json_response['data']]
+    tweets_collection = Database.get_database(db_details)[db_details['tweets_collection']]
+    return tweets_collection.count_documents({"id": {"$in": tweet_ids}, "requests": request_name}) == len(tweet_ids)
+
+def record_volume(request_state, volume, last_pull, tweet_count):
+    '''
+        Updates the volume-statistics of the query with the tweets of a finished pull: tweets_per_hour is smoothed over the pulls
+        with config.paging['volume_smoothing'], the weight of the latest pull.
+    '''
+    now = datetime.now()
+    fields = {'volume.last_pull_tweets': tweet_count, 'volume.updated': now}
 
-    if tweet_bulk_request:
-        tweets_collection.bulk_write(tweet_bulk_request)
+    hours = (now - last_pull).total_seconds() / 3600 if last_pull else 0
+    if hours > 0:
+        rate = tweet_count / hours
+        if 'tweets_per_hour' in (volume or {}):
+            rate = config.paging['volume_smoothing'] * rate + (1 - config.paging['volume_smoothing']) * volume['tweets_per_hour']
+        fields['volume.tweets_per_hour'] = round(rate, 3)
+
+    request_state.set(fields)
+
+def defer_page(request_state, page, wait):
+    '''
+        Stores a page that can't be downloaded now because of the rate limit in the request-document, keyed by its chain like the checkpoints.
+        The next /valet-call of the request resumes it, see resume_deferred_pages().
+    '''
+    request_state.set({
+                        'status' if page['tweet_action'] == 'new' else 'update_status': 'Waiting for the Twitter rate limit.',
+                        'rate_limited_until': datetime.now() + timedelta(seconds=wait),
+                        'pending_pages.' + page['chain_id']: dict(page, deferred=datetime.now())
+                      })
+    # the pending page replaces the checkpoint of its chain
+    request_state.unset(['checkpoints.' + page['chain_id']])
+    request_state.flush()
+
+def resume_deferred_pages(request, request_state):
+    '''
+        Resumes the pages deferred by defer_page(). Like a checkpoint, every page is claimed with a conditional update before it is resumed,
+        so concurrent /valet-calls resume every page only once.
+    '''
+    for chain_id, page in request.get('pending_pages', {}).items():
+        claim = dict(request_state.filter, **{'pending_pages.' + chain_id + '.deferred': page.get('deferred')})
+        if request_state.collection.update_one(claim, {'$unset': {'pending_pages.' + chain_id: "", 'rate_limited_until': ""}}).modified_count:
+            page = {field: value for field, value in page.items() if field != 'deferred'}
+            download_more_tweets(api_bearer=config.twitter['bearer'], api_tweet_search_uri=config.twitter['tweet_search_uri'], **page)
+
+def checkpoint_page(request_state, page):
+    '''
+        Stores the next page of a download-chain in the request-document, after the pages before it are committed.
+        When the invocation that downloads the page dies, resume_checkpoints() continues the chain from here instead of losing its next_token.
+    '''
+    request_state.set({'checkpoints.' + page['chain_id']: dict(page, committed=datetime.now())})
+
+def resume_checkpoints(request, request_state):
+    '''
+        Continues the download-chains whose checkpoint wasn't advanced for config.pipeline['checkpoint_timeout_seconds'], i.e. whose invocation died.
+        A checkpoint is claimed with a conditional update before it is resumed, so concurrent /valet-calls resume every chain only once.
+        Tweets, users and media are written with upserts, a page that is downloaded twice doesn't change the data.
+        The resumed page may be one the dead invocation already wrote, so it is marked "resumed" and doesn't stop the chain early.
+    '''
+    stale = datetime.now() - timedelta(seconds=config.pipeline['checkpoint_timeout_seconds'])
+    for chain_id, page in request.get('checkpoints', {}).items():
+        if page['committed'] > stale:
+            continue
+
+        claim = dict(request_state.filter, **{'checkpoints.' + chain_id + '.committed': page['committed']})
+        if request_state.collection.update_one(claim, {'$unset': {'checkpoints.' + chain_id: ""}}).modified_count:
+            print(f"resuming download-chain {chain_id} ({page['tweet_action']}) after {page['api_tweet_count']} tweets")
+            page = {field: value for field, value in page.items() if field != 'committed'}
+            page['resumed'] = True
+            download_more_tweets(api_bearer=config.twitter['bearer'], api_tweet_search_uri=config.twitter['tweet_search_uri'], **page)
 
 @task
-def download_more_tweets(request_info, api_bearer, api_tweet_search_uri, api_search_query, api_search_parameters, api_since_tweet_id, api_next_token, api_tweet_count, api_until_tweet_id=None, tweet_action=None):
+def download_more_tweets(request_info, api_bearer, api_tweet_search_uri, api_search_query, api_search_parameters, api_since_tweet_id, api_next_token, api_tweet_count, api_until_tweet_id=None, tweet_action=None, chain_id=None, resumed=False):
     
     assert tweet_action in ('new', 'update'), 'tweet_action should be "new" or "update".'
+    chain_id = chain_id or uuid.uuid4().hex
     
     # step one: init new request to twitter-API with "next_token"
-    client = MongoClient(config.mongodb['uri'])
-    db = client[config.mongodb['database']]
+    db = Database.get_database(config.mongodb)
     api_requests = db[config.mongodb['request_collection']]
+    request_state = RequestState(api_requests, request_info['name'], request_info['user'])
 
-    current_request = api_requests.find_one({"name": request_info['name'], "user": request_info['user'] })
+    current_request = request_state.load(projection={'_id': False, 'kill_download': True, 'max_results': True, 'fields': True})
     # below is an emergency kill switch in case the recursive Lambda-invocations do get out of control
     if 'kill_download' in current_request:
         if current_request['kill_download']:
             print(f"download killed at {datetime.now()}")
             return {}
 
+    # the page is deferred instead of failed when the rate limit is used up, the bearer is not stored in the database
+    page = {"request_info": request_info, "api_search_query": api_search_query, "api_search_parameters": api_search_parameters,
+            "api_since_tweet_id": api_since_tweet_id, "api_next_token": api_next_token, "api_tweet_count": api_tweet_count,
+            "api_until_tweet_id": api_until_tweet_id, "tweet_action": tweet_action, "chain_id": chain_id, "resumed": resumed}
+
+    scheduler = Scheduler.get_scheduler(db, config.mongodb)
+    wait = scheduler.wait(config.twitter['ratelimit_max_wait_seconds'])
+    if wait:
+        defer_page(request_state, page, wait)
+        return {}
+
     tweets = TwitterAPI.Tweets(bearer=api_bearer, tweet_search_uri=api_tweet_search_uri, 
                                search_query=api_search_query, search_parameters=api_search_parameters, 
-                               since_tweet_id=api_since_tweet_id, next_token=api_next_token, until_tweet_id=api_until_tweet_id)
+                               since_tweet_id=api_since_tweet_id, next_token=api_next_token, until_tweet_id=api_until_tweet_id,
+                               timeout=(config.twitter['connect_timeout'], config.twitter['read_timeout']), session=TwitterAPI.get_session(config.twitter['pool_size']),
+                               fields=current_request.get('fields', config.twitter['fields']))
      
-    tweets.getdata()
+    with Metrics.timer('twitter_fetch', request_info['name']):
+        tweets.getdata()
+    scheduler.update(tweets.ratelimit)
+
+    if tweets.is_rate_limited:
+        defer_page(request_state, page, scheduler.acquire())
+        return {}
     
     if tweets.is_success:
         if tweets.is_json:
@@ -127,6 +372,14 @@ def download_more_tweets(request_info, api_bearer, api_tweet_search_uri, api_sea
             return {}
 
     continue_download_cycle = True
+
+    # early stop: the page only contains tweets that another chain of the request already wrote (e.g. a concurrent pull), so the pages after it do too
+    # a resumed page can be the last page this chain wrote before its invocation died, it has to continue the chain
+    already_held = (tweet_action == 'new') and (not resumed) and page_already_held(json_response, request_info['name'], config.mongodb)
+    if already_held:
+        continue_download_cycle = False
+        request_state.inc({'volume.early_stops': 1})
+
     if 'max_results' in current_request:
         if (api_tweet_count + json_response['meta']['result_count']) >= current_request['max_results']:
             continue_download_cycle = False
@@ -134,40 +387,218 @@ def download_more_tweets(request_info, api_bearer, api_tweet_search_uri, api_sea
     if not 'next_token' in json_response['meta']:
         continue_download_cycle = False
 
-    # step two: check if new next_token exists, if yes call download_more_tweets() again
-    if continue_download_cycle:
-        download_more_tweets(request_info, 
-                            api_bearer, 
-                            api_tweet_search_uri, 
-                            api_search_query, 
-                            api_search_parameters, 
-                            api_since_tweet_id, 
-                            api_next_token=json_response['meta']['next_token'],
-                            api_tweet_count=api_tweet_count + json_response['meta']['result_count'], 
-                            api_until_tweet_id=api_until_tweet_id,
-                            tweet_action=tweet_action)
-
-    # step three: process_new_data
-    if json_response['meta']['result_count'] > 0:
+    # step two: process_new_data
+    if (json_response['meta']['result_count'] > 0) and (not already_held):
 
         if tweet_action == 'new':
             DataProcessor.process_new_data(request_info, json_response, config.mongodb)
         elif tweet_action == 'update':
-            DataProcessor.update_existing_data(json_response, request_info, config.mongodb)
+            DataProcessor.update_existing_data(json_response, request_info, config.mongodb, trigger_refresh=False)
 
-    # step four: wrap up activities
+    # step three: wrap up activities
     if not continue_download_cycle:
+        finish_download(request_info, request_state, tweet_action, api_tweet_count + json_response['meta']['result_count'], chain_id)
+        return
 
-        if tweet_action == 'new':
-            api_requests.find_one_and_update({"name": request_info['name'], "user": request_info['user'] }, {"$set": {'active': False, 'last_pull_tweets_downloaded': api_tweet_count + json_response['meta']['result_count'], 'last_pull_finished': datetime.now()}})
-        elif tweet_action == 'update':
-            api_requests.find_one_and_update({"name": request_info['name'], "user": request_info['user'] }, {"$set": {'active': False, 'last_update_pull_tweets_downloaded': api_tweet_count + json_response['meta']['result_count'], 'last_update_pull_finished': datetime.now()}})
+    # the page is committed, the chain continues from the checkpoint of the next page if this invocation dies from here on
+    next_page = dict(page, api_next_token=json_response['meta']['next_token'], api_tweet_count=api_tweet_count + json_response['meta']['result_count'], resumed=False)
+    checkpoint_page(request_state, next_page)
+    # every page is its own invocation, its counters are added to the pull-summary before it ends
+    Metrics.flush(request_state)
+    request_state.flush()
+
+    # step four: new next_token exists, call download_more_tweets() again
+    download_more_tweets(api_bearer=api_bearer, api_tweet_search_uri=api_tweet_search_uri, **next_page)
+
+def finish_download(request_info, request_state, tweet_action, tweet_count, chain_id=None):
+    if chain_id:
+        request_state.unset(['checkpoints.' + chain_id])
+
+    if tweet_action == 'new':
+        request_state.set({'active_new': False, 'last_pull_tweets_downloaded': tweet_count, 'last_pull_finished': datetime.now()})
+        last_pull = datetime.fromisoformat(request_info['last_pull']) if 'last_pull' in request_info else None
+        record_volume(request_state, request_state.load(projection={'_id': False, 'volume': True}).get('volume'), last_pull, tweet_count)
+    elif tweet_action == 'update':
+        request_state.set({'active_update': False, 'last_update_pull_tweets_downloaded': tweet_count, 'last_update_pull_finished': datetime.now()})
+
+    Metrics.flush(request_state)
+    request_state.flush()
+
+    # the synergy is refreshed once per maintenance-cycle, not once per page
+    if tweet_action == 'update':
+        refresh_synergy(request_info, config.mongodb)
+
+@task
+def stream_tweets(request_info, api_search_query, api_search_parameters, api_since_tweet_id, api_next_token, api_tweet_count, api_until_tweet_id=None, tweet_action=None, chain_id=None):
+    '''
+        Streaming alternative to download_more_tweets(): downloads all pages of a chain, starting at "api_next_token", in one invocation.
+        It takes the same arguments, the pages before api_next_token have to be committed already (see Valet.continue_chain()).
+        Fetching, enriching and writing run as separate stages (see Pipeline.run_pipeline()), so the next page is fetched while the previous one is written.
+        Kill switch, max_results and rate limit are checked before every page, like in download_more_tweets().
+    '''
+    assert tweet_action in ('new', 'update'), 'tweet_action should be "new" or "update".'
+
+    db = Database.get_database(config.mongodb)
+    api_requests = db[config.mongodb['request_collection']]
+    request_state = RequestState(api_requests, request_info['name'], request_info['user'])
+    scheduler = Scheduler.get_scheduler(db, config.mongodb)
+    fields = request_state.load(projection={'_id': False, 'fields': True}).get('fields', config.twitter['fields'])
+
+    tweets = TwitterAPI.Tweets(bearer=config.twitter['bearer'], tweet_search_uri=config.twitter['tweet_search_uri'], 
+                               search_query=api_search_query, search_parameters=api_search_parameters, 
+                               since_tweet_id=api_since_tweet_id, next_token=api_next_token, until_tweet_id=api_until_tweet_id,
+                               timeout=(config.twitter['connect_timeout'], config.twitter['read_timeout']), session=TwitterAPI.get_session(config.twitter['pool_size']),
+                               fields=fields)
+
+    downloaded = {'count': api_tweet_count}
+    chain_id = chain_id or uuid.uuid4().hex
+
+    def fetch():
+        pages = tweets.pages()
+        while tweets.next_token:
+            current_request = request_state.load(projection={'_id': False, 'kill_download': True, 'max_results': True})
+            if current_request.get('kill_download'):
+                print(f"download killed at {datetime.now()}")
+                return
+
+            if ('max_results' in current_request) and (downloaded['count'] >= current_request['max_results']):
+                return
+
+            page = {"request_info": request_info, "api_search_query": api_search_query, "api_search_parameters": api_search_parameters,
+                    "api_since_tweet_id": api_since_tweet_id, "api_next_token": tweets.next_token, "api_tweet_count": downloaded['count'],
+                    "api_until_tweet_id": api_until_tweet_id, "tweet_action": tweet_action, "chain_id": chain_id}
+
+            wait = scheduler.wait(config.twitter['ratelimit_max_wait_seconds'])
+            if wait:
+                defer_page(request_state, page, wait)
+                return
+
+            with Metrics.timer('twitter_fetch', request_info['name']):
+                json_response = next(pages, None)
+            scheduler.update(tweets.ratelimit)
+
+            if tweets.is_rate_limited:
+                defer_page(request_state, page, scheduler.acquire())
+                return
+
+            if json_response is None:
+                print("Something went wrong. API-response: {}".format(tweets.data))
+                return
+
+            if (tweet_action == 'new') and page_already_held(json_response, request_info['name'], config.mongodb):
+                request_state.inc({'volume.early_stops': 1})
+                return
+
+            downloaded['count'] += json_response['meta']['result_count']
+            yield json_response
+
+    def enrich(json_response):
+        if (tweet_action == 'new') and (json_response['meta']['result_count'] > 0):
+            DataProcessor.enrich_new_data(request_info, json_response, config.mongodb)
+
+        return json_response
+
+    # the write-stage runs in its own thread, it records the checkpoints with its own RequestState
+    checkpoint_state = RequestState(api_requests, request_info['name'], request_info['user'])
+    committed = {'count': api_tweet_count}
+
+    def write(json_response):
+        if json_response['meta']['result_count'] > 0:
+            if tweet_action == 'new':
+                DataProcessor.write_new_data(request_info, json_response, config.mongodb)
+            elif tweet_action == 'update':
+                DataProcessor.update_existing_data(json_response, request_info, config.mongodb, trigger_refresh=False)
+
+        committed['count'] += json_response['meta']['result_count']
+        if 'next_token' in json_response['meta']:
+            checkpoint_page(checkpoint_state, {"request_info": request_info, "api_search_query": api_search_query, "api_search_parameters": api_search_parameters,
+                                               "api_since_tweet_id": api_since_tweet_id, "api_next_token": json_response['meta']['next_token'], "api_tweet_count": committed['count'],
+                                               "api_until_tweet_id": api_until_tweet_id, "tweet_action": tweet_action, "chain_id": chain_id})
+            checkpoint_state.flush()
+
+        return json_response['meta']['result_count']
+
+    stages = [Pipeline.Stage('enrich', enrich), Pipeline.Stage('write', write)]
+    Pipeline.run_pipeline(fetch(), stages, queue_size=config.pipeline['queue_size'])
+
+    for stage in stages:
+        Metrics.record('stream_' + stage.name, request_info['name'], calls=stage.items, seconds=stage.busy)
+
+    # a deferred page is resumed later, the download is not finished yet
+    if not request_state.load(projection={'_id': False, 'pending_pages.' + chain_id: True}).get('pending_pages'):
+        finish_download(request_info, request_state, tweet_action, downloaded['count'], chain_id)
+    else:
+        # the write-stage lags behind the fetch, its last checkpoint may point at the deferred page
+        request_state.unset(['checkpoints.' + chain_id])
+        Metrics.flush(request_state)
+        request_state.flush()
 
 @task
-def refresh_synergy(request_info, db_details):
-    client = MongoClient(db_details['uri'])
-    database = client[db_details['database']]    
+def run_pull(request_info, job_id):
+    '''
+        Runs Valet.pull() for a job started by Valet.enqueue() and records the state of the job in the request-document.
+    '''
+    db = Database.get_database(config.mongodb)
+    request_state = RequestState(db[config.mongodb['request_collection']], request_info['name'], request_info['user'])
+
+    request_state.set({'job.state': 'running', 'job.started': datetime.now()})
+    request_state.flush()
+
+    try:
+        result = Valet.pull(request_info)
+    except Exception as error:
+        request_state.set({'job.state': 'failed', 'job.finished': datetime.now(), 'job.error': '{}: {}'.format(type(error).__name__, error)})
+        request_state.flush()
+        raise
+
+    request_state.set({'job.state': 'done' if result['success'] else 'failed', 'job.finished': datetime.now(), 'job.result': result})
+    request_state.flush()
+
+@task
+def run_maintenance(request_info, since_id):
+    '''
+        Runs the 2nd step of a pull (Valet.maintain()) in the background, see config.valet['defer_maintenance'].
+    '''
+    try:
+        Valet.maintain(request_info, since_id)
+    except Exception as error:
+        db = Database.get_database(config.mongodb)
+        Valet.record_maintenance_error(RequestState(db[config.mongodb['request_collection']], request_info['name'], request_info['user']), error)
+        raise
+
+@task
+def refresh_synergy(request_info, db_details, full_refresh=False):
+    '''
+        Recalculates the synergy of the tweets of a request.
+        By default the refresh is incremental: tweets whose synergy was calculated recently are skipped,
+        because their synergy didn't change by more than config.synergy['min_change'] since then.
+        Refreshes of the same request are debounced, within config.synergy['debounce_seconds'] only the first call does the work.
+        Use full_refresh=True to recalculate every tweet.
+        With config.synergy['server_side'] the synergy is calculated by MongoDB in an update-pipeline, the tweets are not loaded at all.
+    '''
+    database = Database.get_database(db_details)
+    request_state = RequestState(database[db_details['request_collection']], request_info['name'], request_info['user'])
+
+    with Metrics.timer('refresh_synergy', request_info['name']) as timer:
+        recalculate_synergy(request_info, db_details, full_refresh, timer)
+
+    Metrics.flush(request_state)
+    request_state.flush()
+
+def recalculate_synergy(request_info, db_details, full_refresh, timer):
+    database = Database.get_database(db_details)
     tweets_collection = database[db_details['tweets_collection']]
+    api_requests = database[db_details['request_collection']]
+
+    now = datetime.now()
+    if not full_refresh:
+        debounce_from = now - timedelta(seconds=config.synergy['debounce_seconds'])
+        claimed = api_requests.find_one_and_update({"name": request_info['name'], "user": request_info['user'],
+                                                    "$or": [{"last_synergy_refresh": {"$exists": False}}, {"last_synergy_refresh": {"$lt": debounce_from}}]},
+                                                   {"$set": {"last_synergy_refresh": now}},
+                                                   projection={'_id': True})
+        if not claimed:
+            return
 
     if 'last_pull' in request_info:
         date_query = datetime.strptime(request_info['last_pull'], '%Y-%m-%dT%H:%M:%S.%f') - timedelta(days=7)
@@ -176,12 +607,25 @@ def refresh_synergy(request_info, db_details):
 
     db_query = {"requests": request_info['name'], "synergy": {"$ne": 0, "$exists": True}, "created_at": { "$gte": date_query.isoformat() }}
 
-    tweets = tweets_collection.find(db_query, sort=[("synergy", ASCENDING)])
+    if not full_refresh:
+        # the synergy grows by 1 every 100 seconds, tweets refreshed more recently than that would barely move
+        stale_from = now - timedelta(seconds=config.synergy['min_change'] * 100)
+        db_query['$or'] = [{"synergy_updated": {"$exists": False}}, {"synergy_updated": {"$lt": stale_from}}]
+
+    if config.synergy['server_side']:
+        # MongoDB stores dates in milliseconds, see DataProcessor.synergy_expression()
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        result = tweets_collection.update_many(db_query, [{"$set": {'synergy': DataProcessor.synergy_expression(now), 'synergy_updated': now}}])
+        timer.documents_written = result.modified_count
+        return
+
+    tweets = list(tweets_collection.find(db_query, projection={'_id': False, 'id': True, 'created_at': True, 'public_metrics': True}))
+    timer.documents_read = len(tweets)
+    synergies = DataProcessor.calc_synergies(tweets, now)
 
     bulk_write = []
-    for tweet in tweets:
-        synergy = DataProcessor.calc_synergy(tweet)
-        bulk_write.append(UpdateOne({ "id": tweet['id']}, {"$set": {'synergy': synergy}}))
+    for tweet, synergy in zip(tweets, synergies):
+        bulk_write.append(UpdateOne({ "id": tweet['id']}, {"$set": {'synergy': float(synergy), 'synergy_updated': now}}))
 
     if bulk_write:
-        tweets_collection.bulk_write(bulk_write)
+        Database.bulk_write(tweets_collection, bulk_write, ordered=False, request_name=request_info['name'])
@@ -1,7 +1,15 @@
 from datetime import datetime
-from pymongo import UpdateOne, MongoClient
-from backend import config, oembedAPI, AsyncTasks
+from json import dumps
+from pymongo import UpdateOne
+from backend import config, oembedAPI, AsyncTasks, Database, SharedWork, Metrics, Rollups
 import asyncio
+import hashlib
+
+try:
+    import numpy
+except ImportError:
+    # without numpy the batch-functions fall back to the scalar functions
+    numpy = None
 
 def calc_tweet_score(tweet):
     tweet_score = 0
@@ -9,10 +17,19 @@ def calc_tweet_score(tweet):
         tweet_score = (tweet['public_metrics']['like_count'] *2) + (tweet['public_metrics']['reply_count'] * 2) + tweet['public_metrics']['retweet_count'] + tweet['public_metrics']['quote_count']
     return tweet_score
 
-def calc_synergy(tweet):
+def metrics_fingerprint(tweet):
+    '''
+        Compact fingerprint of the public metrics, e.g. "12.3.40.1". Tweets with an unchanged fingerprint are skipped by the maintenance.
+    '''
+    return '.'.join(str(value) for key, value in sorted(tweet.get('public_metrics', {}).items()))
+
+def calc_synergy(tweet, now=None):
+    if not now:
+        now = datetime.now()
+
     synergy = 0
     if 'created_at' and 'public_metrics' in tweet:
-        synergy = datetime.now() - datetime.strptime(tweet['created_at'], '%Y-%m-%dT%H:%M:%S.%fZ')
+        synergy = now - datetime.strptime(tweet['created_at'], '%Y-%m-%dT%H:%M:%S.%fZ')
         synergy = synergy.total_seconds() / 100
         if tweet['public_metrics']['like_count'] > 0:
             synergy = synergy - (tweet['public_metrics']['like_count'] / 4)
@@ -24,34 +41,97 @@ def calc_synergy(tweet):
             synergy = synergy - ((tweet['public_metrics']['reply_count'] + tweet['public_metrics']['quote_count']) * 100)
 
     return synergy
+
+def synergy_expression(now):
+    '''
+        calc_synergy() as aggregation-expression, so MongoDB can calculate the synergy in an update-pipeline.
+        "now" is passed in instead of using $$NOW, to calculate with the same clock as calc_synergy().
+        MongoDB stores dates in milliseconds, so calc_synergy() has to get the same "now" rounded to milliseconds to return the same result.
+    '''
+    like_count = "$public_metrics.like_count"
+    reply_count = "$public_metrics.reply_count"
+    reply_quote_count = {"$add": ["$public_metrics.reply_count", "$public_metrics.quote_count"]}
+    age_in_seconds = {"$divide": [{"$subtract": [now, {"$dateFromString": {"dateString": "$created_at"}}]}, 1000]}
+
+    return {"$cond": [{"$eq": [{"$ifNull": ["$public_metrics", None]}, None]},
+                      0,
+                      # subtracted one after another like in calc_synergy(), so the floats are rounded the same way
+                      {"$subtract": [{"$subtract": [{"$subtract": [{"$divide": [age_in_seconds, 100]},
+                                                                   {"$cond": [{"$gt": [like_count, 0]}, {"$divide": [like_count, 4]}, 0]}]},
+                                                    {"$cond": [{"$gt": [reply_count, 0]}, {"$multiply": [reply_count, 250]}, 0]}]},
+                                     {"$cond": [{"$gt": [reply_quote_count, 0]}, {"$multiply": [reply_quote_count, 100]}, 0]}]}]}
+
+def _metric_arrays(tweets):
+    has_metrics = numpy.array(['public_metrics' in tweet for tweet in tweets], dtype=bool)
+    metrics = numpy.zeros((len(tweets), 4), dtype=numpy.int64)
+    for i, tweet in enumerate(tweets):
+        if has_metrics[i]:
+            public_metrics = tweet['public_metrics']
+            metrics[i] = (public_metrics['like_count'], public_metrics['reply_count'], public_metrics['retweet_count'], public_metrics['quote_count'])
+
+    return has_metrics, metrics[:, 0], metrics[:, 1], metrics[:, 2], metrics[:, 3]
+
+def calc_tweet_scores(tweets):
+    '''
+        Batch-version of calc_tweet_score() for a list of tweets (e.g. a page or a cursor-batch).
+        Returns a numpy-array with the same results as calc_tweet_score(), or a list when numpy is not installed.
+    '''
+    if numpy is None:
+        return [calc_tweet_score(tweet) for tweet in tweets]
+
+    has_metrics, like_count, reply_count, retweet_count, quote_count = _metric_arrays(tweets)
+    scores = (like_count * 2) + (reply_count * 2) + retweet_count + quote_count
+    return numpy.where(has_metrics, scores, 0)
+
+def calc_synergies(tweets, now=None):
+    '''
+        Batch-version of calc_synergy() for a list of tweets (e.g. a page or a cursor-batch).
+        The timestamps are parsed in one go and the arithmetic is done in the same order as calc_synergy(), so the results are identical.
+        Returns a numpy-array, or a list when numpy is not installed.
+    '''
+    if not now:
+        now = datetime.now()
+
+    if numpy is None:
+        return [calc_synergy(tweet, now) for tweet in tweets]
+
+    has_metrics, like_count, reply_count, retweet_count, quote_count = _metric_arrays(tweets)
+
+    # created_at looks like "2021-04-01T12:00:00.000Z", numpy parses it without the "Z"
+    created_at = numpy.array([tweet['created_at'][:-1] if has_metrics[i] else 'NaT' for i, tweet in enumerate(tweets)], dtype='datetime64[us]')
+    age = (numpy.datetime64(now, 'us') - created_at).astype(numpy.int64)
+
+    synergy = (age / 10**6) / 100
+    synergy = synergy - numpy.where(like_count > 0, like_count / 4, 0)
+    synergy = synergy - numpy.where(reply_count > 0, reply_count * 250, 0)
+    synergy = synergy - numpy.where((reply_count + quote_count) > 0, (reply_count + quote_count) * 100, 0)
+
+    return numpy.where(has_metrics, synergy, 0)
  
 def move_include_into_data(json):
     '''
         The enriched information about media and user is not part of the data-array that contains the Tweet. 
         To avoid joins in the database later, the media- and user-arrays are moved into the corresponding data-array.
         The data-array is stored in the database.
+        The includes are indexed by media_key and user-id once, so the join is linear in the size of the page.
     '''
     if not 'includes' in json:
         return
 
-    if 'media' in json['includes']:
-        for includes_element in json['includes']['media']:
-            for data_element in json['data']:
-                if 'attachments' in data_element:
-                    if includes_element['media_key'] in data_element['attachments']['media_keys']:
-                        if not 'media' in data_element:
-                            data_element['media'] = []
+    media_by_key = {media_element['media_key']: media_element for media_element in json['includes'].get('media', [])}
+    users_by_id = {user['id']: user for user in json['includes'].get('users', [])}
 
-                        data_element['media'].append(includes_element)
+    for data_element in json['data']:
+        if media_by_key and ('attachments' in data_element):
+            for media_key in data_element['attachments'].get('media_keys', []):
+                if media_key in media_by_key:
+                    if not 'media' in data_element:
+                        data_element['media'] = []
 
-    if 'users' in json['includes']:
-        for includes_element in json['includes']['users']:
-            for data_element in json['data']:
-                if includes_element['id'] in data_element['author_id']:
-                    if not 'author' in data_element:
-                        data_element['author'] = []
+                    data_element['media'].append(media_by_key[media_key])
 
-                    data_element['author'].append(includes_element)         
+        if data_element.get('author_id') in users_by_id:
+            data_element['author'] = [users_by_id[data_element['author_id']]]
 
     return
 
@@ -65,12 +145,13 @@ def copy_tweethashtags_into_media(json):
     if not 'data' in json:
         return
 
+    media_by_key = {media_element['media_key']: media_element for media_element in json['includes']['media']}
+
     for data_element in json['data']:
-        if ('attachments' in data_element) and ('hashtags' in data_element['entities']):
-            for media_key in data_element['attachments']['media_keys']:
-                for media_element in json['includes']['media']:
-                    if media_element['media_key'] == media_key:
-                        media_element['hashtags'] = [tag['tag'] for tag in data_element['entities']['hashtags']]
+        if ('attachments' in data_element) and ('hashtags' in data_element.get('entities', {})):
+            for media_key in data_element['attachments'].get('media_keys', []):
+                if media_key in media_by_key:
+                    media_by_key[media_key]['hashtags'] = [tag['tag'] for tag in data_element['entities']['hashtags']]
 
 def add_request_name(json, request_name):
     '''
@@ -83,80 +164,167 @@ def add_request_name(json, request_name):
 
     return
 
-def update_existing_data(tweets, request_info, db_details):
+def update_existing_data(tweets, request_info, db_details, trigger_refresh=True):
     '''
         This function will take the payload data to update existing tweets.
         This is useful to update the public metrics (likes, replies etc.) of a tweet.
         The tweet_score in the user-document will also be updated.
+        The fingerprints of the stored tweets are loaded with one query upfront, tweets with an unchanged fingerprint are neither recalculated nor written.
+        "metrics_changed" records when the metrics of a tweet moved the last time, the maintenance uses it to skip settled tweets.
+        Set trigger_refresh=False when more pages follow, the caller then refreshes the synergy once at the end.
     '''
 
     if 'data' in tweets:
-        client = MongoClient(db_details['uri'])
-        database = client[db_details['database']]
+        database = Database.get_database(db_details)
 
         tweets_db = database[db_details['tweets_collection']]
         users = database[db_details['users_collection']]
+
+        existing_tweets = {}
+        for existing_tweet in tweets_db.find({"id": {"$in": [tweet['id'] for tweet in tweets['data']]}}, projection={'_id': False, 'id': True, 'author_id': True, 'tweet_score': True, 'metrics_fingerprint': True}):
+            existing_tweets[existing_tweet['id']] = existing_tweet
+
+        Metrics.record('update_existing_data', request_info['name'], documents_read=len(existing_tweets))
+
         tweet_bulk = []
         user_bulk = []
+        score_diffs = {}
+        filled_stubs = False
         for tweet in tweets['data']:
-            existing_tweet = tweets_db.find_one({"id": tweet['id']})
+            existing_tweet = existing_tweets.get(tweet['id'], {})
+            fingerprint = metrics_fingerprint(tweet)
 
-            if not 'tweet_score' in existing_tweet:
-                existing_tweet['tweet_score'] = 0
+            # a stored {id, requests}-stub gets its fields now, its user statistics weren't counted yet
+            if existing_tweet and (not 'author_id' in existing_tweet):
+                filled_stubs = True
 
+            if existing_tweet.get('metrics_fingerprint') == fingerprint:
+                continue
+
+            old_score = existing_tweet.get('tweet_score', 0)
             new_score = calc_tweet_score(tweet)
 
-            if existing_tweet['tweet_score'] != new_score:
-                score_diff = new_score - existing_tweet['tweet_score']
+            if old_score != new_score:
+                score_diff = new_score - old_score
                 if 'author_id' in tweet:
-                    keyvalue = 'tweet_scores.'+request_info['name']
-                    user_bulk.append(UpdateOne({ "id": tweet['author_id']}, { "$inc": { keyvalue: score_diff } }))
+                    score_diffs[tweet['author_id']] = score_diffs.get(tweet['author_id'], 0) + score_diff
+                    if config.rollups['embedded_user_statistics']:
+                        keyvalue = 'tweet_scores.'+request_info['name']
+                        user_bulk.append(UpdateOne({ "id": tweet['author_id']}, { "$inc": { keyvalue: score_diff } }))
 
             tweet['tweet_score'] = new_score
 
             tweet['synergy'] = calc_synergy(tweet)
+            tweet['synergy_updated'] = datetime.now()
+            tweet['metrics_fingerprint'] = fingerprint
+            tweet['metrics_changed'] = tweet['synergy_updated']
 
             tweet_bulk.append(UpdateOne({ "id": tweet['id']}, { "$set": tweet }, upsert=True))
 
         if tweet_bulk:
-            tweets_db.bulk_write(tweet_bulk)
+            Database.bulk_write(tweets_db, tweet_bulk, request_name=request_info['name'])
 
         if user_bulk:
-            users.bulk_write(user_bulk)
+            Database.bulk_write(users, user_bulk, ordered=False, request_name=request_info['name'])
 
-    AsyncTasks.refresh_synergy(request_info, db_details)
+        if config.rollups['enabled']:
+            Rollups.add_scores(request_info['name'], score_diffs, db_details)
 
-def process_new_data(request_info, json, db_details):
+        if filled_stubs:
+            AsyncTasks.update_user_statistics(tweets['meta']['newest_id'], tweets['meta']['oldest_id'], request_info['name'], db_details)
+
+    if trigger_refresh:
+        AsyncTasks.refresh_synergy(request_info, db_details)
+
+def enrich_new_data(request_info, json, db_details):
     '''
-        This function takes the whole payload received from the Twitter-API and processes it for the dashboard.
+        First half of process_new_data(): moves the includes into the tweets, loads the embedded html and calculates tweet_score and synergy.
+        Nothing is written to the database.
+        When the request is part of a batch, the embedded html is only loaded for the tweets this request claims first.
     '''
+    if 'data' in json:
+        with Metrics.timer('move_include_into_data', request_info['name']):
+            move_include_into_data(json)
+
+        shared_work = SharedWork.get_shared_work(request_info, db_details)
+        if shared_work is None:
+            to_embed = json
+        else:
+            claimed = shared_work.claim_many('tweet', [tweet['id'] for tweet in json['data']], request_info['name'])
+            to_embed = {'data': [tweet for tweet in json['data'] if tweet['id'] in claimed]}
 
-    client = MongoClient(db_details['uri'])
-    database = client[db_details['database']]
+        tweets = Database.get_database(db_details)[db_details['tweets_collection']]
+        with Metrics.timer('oembed', request_info['name']):
+            asyncio.run(oembedAPI.get_embedded_html(to_embed, config, tweets))
+
+        for tweet in json['data']:
+            tweet['tweet_score'] = calc_tweet_score(tweet)
+            tweet['synergy'] = calc_synergy(tweet)
+            tweet['synergy_updated'] = datetime.now()
+            tweet['metrics_fingerprint'] = metrics_fingerprint(tweet)
+            tweet['metrics_changed'] = tweet['synergy_updated']
 
+def content_hash(document):
+    '''
+        Fingerprint of a user- or media-document as Twitter returned it. It is stored with the document ("content_hash"),
+        so an unchanged document can be detected without comparing all of its fields.
+    '''
+    return hashlib.sha1(dumps(document, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def load_content_hashes(collection, key, values, projection=None):
+    # one query for the stored fingerprints of a page, keyed by "key"
+    projection = dict(projection or {}, **{'_id': False, key: True, 'content_hash': True})
+    return {document[key]: document for document in collection.find({key: {"$in": values}}, projection=projection)}
+
+def write_new_data(request_info, json, db_details):
+    '''
+        Second half of process_new_data(): writes users, tweets and media of an enriched payload to the database.
+        Every document is written with a single upsert that sets its fields and adds the request-name, all bulks are unordered.
+        Users and media whose content_hash didn't change are skipped.
+        When the request is part of a batch, documents that another request of the batch already wrote are skipped.
+    '''
+    database = Database.get_database(db_details)
+    shared_work = SharedWork.get_shared_work(request_info, db_details)
+
+    def first_writers(kind, keys):
+        # the keys of the page whose documents this request writes, claimed with one round-trip
+        return set(keys) if shared_work is None else shared_work.claim_many(kind, keys, request_info['name'])
+
+    documents_read = 0
     if 'users' in json['includes']:
         users = database[db_details['users_collection']]
+        stored_users = load_content_hashes(users, 'id', [user['id'] for user in json['includes']['users']])
+        documents_read += len(stored_users)
+
+        claimed = first_writers('user', [user['id'] for user in json['includes']['users']])
         bulk_request = []
         for user in json['includes']['users']:
-            bulk_request.append(UpdateOne({ "id": user['id']}, { "$set": user }, upsert=True))
+            if not user['id'] in claimed:
+                continue
 
-        users.bulk_write(bulk_request)
+            user_hash = content_hash(user)
+            if stored_users.get(user['id'], {}).get('content_hash') == user_hash:
+                continue
 
-    if 'data' in json:
-        move_include_into_data(json)
+            bulk_request.append(UpdateOne({ "id": user['id']}, { "$set": dict(user, content_hash=user_hash) }, upsert=True))
+
+        if bulk_request:
+            Database.bulk_write(users, bulk_request, ordered=False, request_name=request_info['name'])
 
+    if 'data' in json:
         tweets = database[db_details['tweets_collection']]
+        claimed = first_writers('tweet', [tweet['id'] for tweet in json['data']])
         bulk_request = []
 
-        asyncio.run(oembedAPI.get_embedded_html(json, config))
         for tweet in json['data']:
-            tweet['tweet_score'] = calc_tweet_score(tweet)
-            tweet['synergy'] = calc_synergy(tweet)
-
-            bulk_request.append(UpdateOne({ "id": tweet['id']}, { "$set": tweet}, upsert=True))
-            bulk_request.append(UpdateOne({ "id": tweet['id']}, {"$addToSet": { "requests": request_info['name'] } }))
+            if tweet['id'] in claimed:
+                bulk_request.append(UpdateOne({ "id": tweet['id']}, { "$set": tweet, "$addToSet": { "requests": request_info['name'] } }, upsert=True))
+            else:
+                # the first writer may not have written the tweet yet or may have failed, so the tweet is inserted with its fields
+                # instead of as a bare {id, requests}-stub, the first writer's $set adds the embedded html later
+                bulk_request.append(UpdateOne({ "id": tweet['id']}, {"$setOnInsert": tweet, "$addToSet": { "requests": request_info['name'] } }, upsert=True))
 
-        tweets.bulk_write(bulk_request)
+        Database.bulk_write(tweets, bulk_request, ordered=False, request_name=request_info['name'])
 
         AsyncTasks.update_user_statistics(json['meta']['newest_id'], json['meta']['oldest_id'], request_info['name'], db_details)
 
@@ -164,12 +332,35 @@ def process_new_data(request_info, json, db_details):
         copy_tweethashtags_into_media(json)
 
         media = database[db_details['media_collection']]
+        stored_media = load_content_hashes(media, 'media_key', [media_element['media_key'] for media_element in json['includes']['media']], {'requests': True})
+        documents_read += len(stored_media)
+
+        claimed = first_writers('media', [media_element['media_key'] for media_element in json['includes']['media']])
         bulk_request = []
         for media_element in json['includes']['media']:
-            bulk_request.append(UpdateOne({ "media_key": media_element['media_key']}, { "$set": media_element }, upsert=True))
-            bulk_request.append(UpdateOne({ "media_key": media_element['media_key']}, {"$addToSet": { "requests": request_info['name'] } }))
+            stored_element = stored_media.get(media_element['media_key'], {})
+            has_request = request_info['name'] in stored_element.get('requests', [])
+
+            if media_element['media_key'] in claimed:
+                media_hash = content_hash(media_element)
+                if stored_element.get('content_hash') != media_hash:
+                    bulk_request.append(UpdateOne({ "media_key": media_element['media_key']}, { "$set": dict(media_element, content_hash=media_hash), "$addToSet": { "requests": request_info['name'] } }, upsert=True))
+                    continue
 
-        media.bulk_write(bulk_request)
+            if not has_request:
+                bulk_request.append(UpdateOne({ "media_key": media_element['media_key']}, {"$addToSet": { "requests": request_info['name'] } }, upsert=True))
+
+        if bulk_request:
+            Database.bulk_write(media, bulk_request, ordered=False, request_name=request_info['name'])
+
+    Metrics.record('write_new_data', request_info['name'], documents_read=documents_read)
+
+def process_new_data(request_info, json, db_details):
+    '''
+        This function takes the whole payload received from the Twitter-API and processes it for the dashboard.
+    '''
+    enrich_new_data(request_info, json, db_details)
+    write_new_data(request_info, json, db_details)
 
 def main():
     print('Test OK')
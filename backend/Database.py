@@ -0,0 +1,130 @@
+from datetime import datetime
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, OperationFailure
+from backend import Metrics
+import os
+import threading
+import time
+
+_clients = {}
+_client_lock = threading.Lock()
+
+# one entry per query shape the backend uses: (collection-setting, index-keys, unique)
+# the unique indexes make concurrent upserts of the same document safe, MongoDB retries the losing upsert as an update
+INDEXES = [
+    ('request_collection', [("name", ASCENDING), ("user", ASCENDING)], False),
+    ('request_collection', [("job.id", ASCENDING)], False),
+    ('tweets_collection', [("id", ASCENDING)], True),
+    ('tweets_collection', [("requests", ASCENDING), ("id", ASCENDING)], False),
+    ('tweets_collection', [("requests", ASCENDING), ("created_at", ASCENDING), ("synergy", ASCENDING)], False),
+    ('tweets_collection', [("attachments.media_keys", ASCENDING)], False),
+    ('tweets_archive_collection', [("id", ASCENDING)], True),
+    ('users_collection', [("id", ASCENDING)], True),
+    ('media_collection', [("media_key", ASCENDING)], True),
+    ('user_rollup_collection', [("request", ASCENDING), ("user_id", ASCENDING)], True),
+    ('user_rollup_collection', [("request", ASCENDING), ("score", DESCENDING)], False),
+    ('hashtag_rollup_collection', [("request", ASCENDING), ("bucket", ASCENDING), ("tag", ASCENDING)], True),
+    ('media_rollup_collection', [("request", ASCENDING), ("tag", ASCENDING), ("media_key", ASCENDING)], True),
+    ('media_rollup_collection', [("request", ASCENDING), ("tag", ASCENDING), ("created_at", DESCENDING)], False),
+]
+
+# the claims of a batch (see SharedWork) are only needed while its tasks run
+SHARED_WORK_TTL = 24 * 3600
+
+class ClientInfo:
+    def __init__(self, client, init_ms) -> None:
+        self.client = client
+        self.created = datetime.now()
+        self.init_ms = init_ms
+        self.used = 0
+
+    def toJSON(self):
+        return {'created': self.created.isoformat(), 'init_ms': self.init_ms, 'used': self.used}
+
+def _client_key(db_details):
+    # MongoClient is not fork-safe, a forked worker gets its own client
+    return (db_details['uri'], os.getpid())
+
+def is_warm(db_details):
+    '''
+        Returns True when this process already holds a client for the database, e.g. in a warm Lambda-container.
+    '''
+    return _client_key(db_details) in _clients
+
+def get_client(db_details):
+    '''
+        Returns the MongoClient for the database.
+        The client (and its connection pool) is created once per process and reused afterwards, also across warm Lambda-invocations.
+        The pool size is taken from the "max_pool_size" and "min_pool_size" settings in the db_details.
+    '''
+    key = _client_key(db_details)
+    if not key in _clients:
+        with _client_lock:
+            if not key in _clients:
+                started = time.perf_counter()
+                client = MongoClient(db_details['uri'],
+                                     maxPoolSize=db_details.get('max_pool_size', 10),
+                                     minPoolSize=db_details.get('min_pool_size', 0))
+                # connect right away, so the cold-start costs (DNS, TLS & handshake) are measured here
+                client.admin.command('ping')
+                _clients[key] = ClientInfo(client, round((time.perf_counter() - started) * 1000, 2))
+
+                if db_details.get('ensure_indexes', True):
+                    ensure_indexes(client[db_details['database']], db_details)
+
+    client_info = _clients[key]
+    client_info.used += 1
+    return client_info.client
+
+def ensure_indexes(database, db_details):
+    '''
+        Creates the indexes for all query shapes of the backend. Existing indexes are left untouched.
+        This runs once per process, when the client is created.
+    '''
+    for collection, keys, unique in INDEXES:
+        try:
+            database[db_details[collection]].create_index(keys, unique=unique, background=True)
+        except OperationFailure as error:
+            if not unique:
+                raise
+
+            # e.g. the collection already contains duplicates, the lookups still need the index
+            print('Unique index on {}.{} not created: {}'.format(db_details[collection], keys, error))
+            database[db_details[collection]].create_index(keys, background=True)
+
+    database[db_details['shared_work_collection']].create_index([("created", ASCENDING)], expireAfterSeconds=SHARED_WORK_TTL, background=True)
+
+def bulk_write(collection, requests, ordered=True, request_name=None):
+    '''
+        collection.bulk_write() that retries the upserts which lost the race against a concurrent upsert of the same document.
+        The unique index rejects them with a duplicate key error, the retry then updates the document the other upsert created.
+        Every retry makes progress, because a rejected upsert can't be rejected a second time.
+        The time and the written documents are recorded as stage "bulk_write_<collection>" of "request_name" (see Metrics).
+    '''
+    with Metrics.timer('bulk_write_' + collection.name, request_name) as timer:
+        while True:
+            try:
+                result = collection.bulk_write(requests, ordered=ordered)
+                timer.documents_written += result.upserted_count + result.modified_count
+                return result
+            except BulkWriteError as error:
+                write_errors = error.details['writeErrors']
+                if any(write_error['code'] != 11000 for write_error in write_errors):
+                    raise
+
+                timer.documents_written += error.details['nUpserted'] + error.details['nModified']
+                if ordered:
+                    # an ordered bulk stops at the first error
+                    requests = requests[write_errors[0]['index']:]
+                else:
+                    requests = [requests[write_error['index']] for write_error in write_errors]
+
+def get_database(db_details):
+    return get_client(db_details)[db_details['database']]
+
+def client_info(db_details):
+    key = _client_key(db_details)
+    if not key in _clients:
+        return None
+
+    return _clients[key]
@@ -0,0 +1,126 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from importlib import import_module
+import functools
+import threading
+import traceback
+
+def _run_task(task_path, args, kwargs):
+    # runs the undecorated function, so the task is not dispatched a second time
+    module_path, function_name = task_path.rsplit('.', 1)
+    return getattr(import_module(module_path), function_name).sync(*args, **kwargs)
+
+def _run_process_task(task_path, args, kwargs):
+    # in a process-worker the task is only done when the tasks it started are done
+    result = _run_task(task_path, args, kwargs)
+    get_executor().join()
+    return result
+
+def _init_process_worker(max_workers):
+    # a worker can't hand tasks back to the pool of its parent, the tasks it starts run in its own thread-pool
+    global _executor
+    _executor = PoolExecutor(ThreadPoolExecutor(max_workers=max_workers))
+
+class ZappaExecutor:
+    '''
+        Runs every task in its own Lambda-invocation. Outside of Lambda zappa runs the task synchronously.
+    '''
+    def submit(self, task_path, function, args, kwargs):
+        from zappa.asynchronous import task as zappa_task
+        return zappa_task(function)(*args, **kwargs)
+
+    def join(self):
+        pass
+
+class InlineExecutor:
+    '''
+        Runs every task synchronously in the calling thread.
+    '''
+    def submit(self, task_path, function, args, kwargs):
+        return function(*args, **kwargs)
+
+    def join(self):
+        pass
+
+class PoolExecutor:
+    '''
+        Runs the tasks in a thread- or process-pool of this host.
+        join() blocks until all tasks are done, including the tasks they started themselves.
+    '''
+    def __init__(self, pool, runner=_run_task) -> None:
+        self.pool = pool
+        self.runner = runner
+        self.futures = set()
+        self.lock = threading.Lock()
+
+    def submit(self, task_path, function, args, kwargs):
+        future = self.pool.submit(self.runner, task_path, args, kwargs)
+        with self.lock:
+            self.futures.add(future)
+
+        future.add_done_callback(self.task_done)
+        return future
+
+    def task_done(self, future):
+        with self.lock:
+            self.futures.discard(future)
+
+        if future.exception():
+            print('Task failed:')
+            traceback.print_exception(type(future.exception()), future.exception(), future.exception().__traceback__)
+
+    def join(self):
+        while True:
+            with self.lock:
+                futures = list(self.futures)
+
+            if not futures:
+                return
+
+            wait(futures)
+
+def create_executor(name, max_workers=None):
+    if name == 'zappa':
+        return ZappaExecutor()
+    if name == 'inline':
+        return InlineExecutor()
+    if name == 'thread':
+        return PoolExecutor(ThreadPoolExecutor(max_workers=max_workers))
+    if name == 'process':
+        return PoolExecutor(ProcessPoolExecutor(max_workers=max_workers, initializer=_init_process_worker, initargs=(max_workers,)), _run_process_task)
+
+    raise Exception('Unknown executor "{}". Please use "zappa", "inline", "thread" or "process".'.format(name))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                from backend import config
+                _executor = create_executor(config.tasks['executor'], config.tasks['max_workers'])
+
+    return _executor
+
+def set_executor(executor):
+    '''
+        Replaces the executor of this process, e.g. to run the pipeline in a thread-pool for tests and benchmarks.
+    '''
+    global _executor
+    with _executor_lock:
+        _executor = executor
+
+def task(function):
+    '''
+        Replacement for zappa's @task-decorator: calling the decorated function hands it to the configured executor.
+        The undecorated function is available as ".sync", like with zappa.
+    '''
+    task_path = '{}.{}'.format(function.__module__, function.__name__)
+
+    @functools.wraps(function)
+    def dispatch(*args, **kwargs):
+        return get_executor().submit(task_path, function, args, kwargs)
+
+    dispatch.sync = function
+    return dispatch
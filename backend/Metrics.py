@@ -0,0 +1,106 @@
+import threading
+import time
+
+PREFIX = 'napoleon'
+
+COUNTERS = [
+    ('calls', 'stage_calls_total', 'Number of times a stage ran.'),
+    ('seconds', 'stage_seconds_total', 'Wall time spent in a stage, stages that call other stages include their time.'),
+    ('documents_read', 'documents_read_total', 'Documents a stage read from MongoDB.'),
+    ('documents_written', 'documents_written_total', 'Documents a stage inserted or modified in MongoDB.')
+]
+
+class Timer:
+    '''
+        Context manager that times one run of a stage for a saved request.
+        Set "documents_read" and "documents_written" inside the block, they are recorded together with the time.
+    '''
+    def __init__(self, stage, request_name) -> None:
+        self.stage = stage
+        self.request_name = request_name
+        self.documents_read = 0
+        self.documents_written = 0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.stage, self.request_name, seconds=time.perf_counter() - self.started,
+               documents_read=self.documents_read, documents_written=self.documents_written)
+        return False
+
+_lock = threading.Lock()
+# process-wide counters for /metrics, keyed by (request_name, stage)
+_totals = {}
+# counters that are not yet added to the pull-summary of the request-document, keyed by request_name and stage
+_pending = {}
+_gauges = {}
+
+def timer(stage, request_name=None):
+    return Timer(stage, request_name)
+
+def record(stage, request_name=None, calls=1, seconds=0.0, documents_read=0, documents_written=0):
+    values = {'calls': calls, 'seconds': seconds, 'documents_read': documents_read, 'documents_written': documents_written}
+    with _lock:
+        counter_sets = [_totals.setdefault((request_name or '', stage), {})]
+        if request_name:
+            counter_sets.append(_pending.setdefault(request_name, {}).setdefault(stage, {}))
+
+        for counters in counter_sets:
+            for field, value in values.items():
+                counters[field] = counters.get(field, 0) + value
+
+def set_gauge(name, value, help_text):
+    if value is None:
+        return
+
+    with _lock:
+        _gauges[name] = (float(value), help_text)
+
+def discard(request_name):
+    with _lock:
+        _pending.pop(request_name, None)
+
+def flush(request_state):
+    '''
+        Adds the counters of the request that were recorded in this process since the last flush to "pull_metrics" of the request-document.
+        The counters are written with $inc, so every task of a pull (also in another process) adds its part to the same summary.
+    '''
+    with _lock:
+        stages = _pending.pop(request_state.filter['name'], {})
+
+    fields = {}
+    for stage, counters in stages.items():
+        for field, value in counters.items():
+            if value:
+                fields['pull_metrics.{}.{}'.format(stage, field)] = round(value, 6) if field == 'seconds' else value
+
+    if fields:
+        request_state.inc(fields)
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render():
+    '''
+        Returns the counters and gauges of this process in the Prometheus text format.
+        Every process (e.g. every Lambda-container) has its own counters, the persisted "pull_metrics" sum up all processes of a pull.
+    '''
+    with _lock:
+        totals = {key: dict(counters) for key, counters in _totals.items()}
+        gauges = dict(_gauges)
+
+    lines = []
+    for field, name, help_text in COUNTERS:
+        lines.append('# HELP {}_{} {}'.format(PREFIX, name, help_text))
+        lines.append('# TYPE {}_{} counter'.format(PREFIX, name))
+        for (request_name, stage), counters in sorted(totals.items()):
+            lines.append('{}_{}{{request="{}",stage="{}"}} {}'.format(PREFIX, name, escape(request_name), escape(stage), round(counters[field], 6)))
+
+    for name, (value, help_text) in sorted(gauges.items()):
+        lines.append('# HELP {}_{} {}'.format(PREFIX, name, help_text))
+        lines.append('# TYPE {}_{} gauge'.format(PREFIX, name))
+        lines.append('{}_{} {}'.format(PREFIX, name, value))
+
+    return '\n'.join(lines) + '\n'
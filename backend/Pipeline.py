@@ -0,0 +1,86 @@
+import queue
+import threading
+import time
+
+_DONE = object()
+
+class Stage:
+    def __init__(self, name, function) -> None:
+        self.name = name
+        self.function = function
+        self.items = 0
+        self.busy = 0.0
+
+    def run(self, item):
+        started = time.perf_counter()
+        result = self.function(item)
+        self.busy += time.perf_counter() - started
+        self.items += 1
+        return result
+
+    def toJSON(self):
+        return {'items': self.items, 'busy_seconds': round(self.busy, 3)}
+
+def run_pipeline(source, stages, queue_size=2):
+    '''
+        Runs the iterator "source" and every stage in its own thread, connected by bounded queues.
+        When a queue is full the thread in front of it blocks (backpressure), so at most "queue_size" items wait between two stages
+        and the wall time of the pipeline is close to the time of its slowest stage.
+        Returns the results of the last stage. The first exception of any stage is raised after all threads have stopped.
+    '''
+    queues = [queue.Queue(maxsize=queue_size) for stage in stages]
+    results = []
+    errors = []
+    failed = threading.Event()
+
+    def produce():
+        try:
+            for item in source:
+                if failed.is_set():
+                    break
+
+                queues[0].put(item)
+        except Exception as error:
+            errors.append(error)
+            failed.set()
+        finally:
+            queues[0].put(_DONE)
+
+    def work(index, stage):
+        output = queues[index + 1] if index + 1 < len(stages) else None
+        while True:
+            item = queues[index].get()
+            if item is _DONE:
+                break
+
+            # after an error the queue is drained, so the threads in front of it don't block forever
+            if failed.is_set():
+                continue
+
+            try:
+                result = stage.run(item)
+            except Exception as error:
+                errors.append(error)
+                failed.set()
+                continue
+
+            if output:
+                output.put(result)
+            else:
+                results.append(result)
+
+        if output:
+            output.put(_DONE)
+
+    threads = [threading.Thread(target=produce, daemon=True)]
+    threads += [threading.Thread(target=work, args=(index, stage), daemon=True) for index, stage in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return results
@@ -0,0 +1,54 @@
+# the steps of a pull run concurrently, each has its own flag and "active" is true while one of them is
+ACTIVE_FLAGS = ['active_new', 'active_update']
+
+class RequestState:
+    '''
+        Collects the state-transitions of a request-document (status, active, pull-timestamps etc.) and writes them with one update.
+        Call flush() whenever the state has to be visible to others, e.g. before an async task is started.
+        "active" is derived from ACTIVE_FLAGS by the database after every flush() that changed one of them, set the flags instead.
+    '''
+    def __init__(self, collection, name, user) -> None:
+        self.collection = collection
+        self.filter = {"name": name, "user": user}
+        self.pending = {}
+        self.pending_unset = set()
+        self.pending_inc = {}
+
+    def load(self, projection=None):
+        return self.collection.find_one(self.filter, projection=projection)
+
+    def set(self, fields):
+        self.pending.update(fields)
+        self.pending_unset.difference_update(fields)
+
+    def unset(self, fields):
+        for field in fields:
+            self.pending.pop(field, None)
+            self.pending_unset.add(field)
+
+    def inc(self, fields):
+        for field, value in fields.items():
+            self.pending_inc[field] = self.pending_inc.get(field, 0) + value
+
+    def flush(self):
+        if not (self.pending or self.pending_unset or self.pending_inc):
+            return
+
+        update = {}
+        if self.pending:
+            update['$set'] = self.pending
+
+        if self.pending_unset:
+            update['$unset'] = {field: "" for field in self.pending_unset}
+
+        if self.pending_inc:
+            update['$inc'] = self.pending_inc
+
+        self.collection.update_one(self.filter, update)
+        if any(flag in self.pending for flag in ACTIVE_FLAGS):
+            # evaluated on the stored document, so it also sees the flag of the other step
+            self.collection.update_one(self.filter, [{"$set": {"active": {"$or": [{"$eq": ["$" + flag, True]} for flag in ACTIVE_FLAGS]}}}])
+
+        self.pending = {}
+        self.pending_unset = set()
+        self.pending_inc = {}
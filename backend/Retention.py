@@ -0,0 +1,141 @@
+from datetime import datetime, timedelta
+from pymongo import ReplaceOne, ASCENDING
+from backend import Database, config
+
+TWITTER_TIMESTAMP = '%Y-%m-%dT%H:%M:%S.000Z'
+
+def policy(request):
+    '''
+        The retention-policy of a saved request: config.retention, overridden by the "retention"-field of the request-document.
+        The retention is off unless "enabled" is set in config.retention or for the request, e.g. {"retention": {"enabled": true}}.
+        Tweets are never compacted while they can still be downloaded (7 days) or maintained (maintenance_delta).
+    '''
+    request_policy = dict(config.retention, **request.get('retention', {}))
+    request_policy['after_days'] = max(request_policy['after_days'], 7, request.get('maintenance_delta', 0) / 24)
+    return request_policy
+
+def cutoff(request_policy, now=None):
+    # tweets created before the cutoff are expired for the request
+    return ((now or datetime.utcnow()) - timedelta(days=request_policy['after_days'])).strftime(TWITTER_TIMESTAMP)
+
+def expired_filter(request_name, request_policy, now=None):
+    # the index on (requests, created_at) serves this query
+    # tweets the request already kept for other requests ("retained", see plan_batch()) are not selected again
+    return {"requests": request_name, "created_at": {"$lt": cutoff(request_policy, now)}, "compacted": {"$exists": False}, "retained": {"$ne": request_name}}
+
+def owner_policies(database, db_details, request_names):
+    '''
+        The retention-policies of the requests that share the tweets of a batch, keyed by request-name.
+        Requests of different users can have the same name, a disabled or the longer retention wins. A request that doesn't exist anymore gets the default policy.
+    '''
+    def keeps_longer(request_policy):
+        return (not request_policy['enabled'], request_policy['after_days'])
+
+    policies = {}
+    for request in database[db_details['request_collection']].find({"name": {"$in": list(request_names)}}, projection={'_id': False, 'name': True, 'retention': True, 'maintenance_delta': True}):
+        request_policy = policy(request)
+        if (not request['name'] in policies) or (keeps_longer(policies[request['name']]) < keeps_longer(request_policy)):
+            policies[request['name']] = request_policy
+
+    for request_name in request_names:
+        if not request_name in policies:
+            policies[request_name] = policy({})
+
+    return policies
+
+def plan_batch(tweets, request_name, policies, now=None):
+    '''
+        Decides what the retention of "request_name" does with the tweets of a batch. A tweet is shared by the requests in its "requests"-array,
+        so it is only compacted or archived when it expired for all of them. A request without retention keeps its tweets forever.
+        - another request still keeps the tweet: with mode "archive" the request is removed from the tweet ("release"),
+          with mode "slim" the tweet stays as it is and is marked "retained", it is compacted by the retention of the last request.
+        - the tweet expired for all requests: the requests with mode "archive" are removed, the tweet is compacted with the fields
+          that all "slim"-requests compact. Without "slim"-requests the tweet is archived.
+        Returns {'archive': [tweet], 'release': {request_name: [id]}, 'retain': [id], 'compact': {(field, ...): [id]}}.
+    '''
+    cutoffs = {name: cutoff(request_policy, now) for name, request_policy in policies.items()}
+    plan = {'archive': [], 'release': {}, 'retain': [], 'compact': {}}
+
+    for tweet in tweets:
+        owners = tweet['requests']
+        if any((not policies[owner]['enabled']) or (tweet['created_at'] >= cutoffs[owner]) for owner in owners):
+            if policies[request_name]['mode'] == 'archive':
+                plan['release'].setdefault(request_name, []).append(tweet['id'])
+            else:
+                plan['retain'].append(tweet['id'])
+            continue
+
+        slim_owners = [owner for owner in owners if policies[owner]['mode'] != 'archive']
+        if not slim_owners:
+            plan['archive'].append(tweet)
+            continue
+
+        for owner in owners:
+            if not owner in slim_owners:
+                plan['release'].setdefault(owner, []).append(tweet['id'])
+
+        compact_fields = set.intersection(*(set(policies[owner]['compact_fields']) for owner in slim_owners))
+        plan['compact'].setdefault(tuple(sorted(compact_fields)), []).append(tweet['id'])
+
+    return plan
+
+def compact_batch(tweets_collection, tweet_ids, compact_fields):
+    '''
+        Slims the tweets down to their archival shape: the "compact_fields" are removed,
+        the fields the statistics, rollups and rankings use (id, author, created_at, metrics, scores, hashtags, media_keys) are kept.
+    '''
+    update = {"$set": {"compacted": datetime.now()}}
+    if compact_fields:
+        update["$unset"] = {field: "" for field in compact_fields}
+
+    result = tweets_collection.update_many({"id": {"$in": tweet_ids}}, update)
+    return result.modified_count
+
+def release_batch(tweets_collection, tweet_ids, request_name):
+    '''
+        Removes a request with mode "archive" from tweets that other requests still keep, the tweet is archived when the last request releases it.
+        "archived_for" records the released requests.
+    '''
+    result = tweets_collection.update_many({"id": {"$in": tweet_ids}}, {"$pull": {"requests": request_name}, "$addToSet": {"archived_for": request_name}})
+    return result.modified_count
+
+def retain_batch(tweets_collection, tweet_ids, request_name):
+    result = tweets_collection.update_many({"id": {"$in": tweet_ids}}, {"$addToSet": {"retained": request_name}})
+    return result.modified_count
+
+def archive_batch(database, db_details, tweets, request_name=None):
+    '''
+        Moves the tweets to the archive-collection. The archive is written before the tweets are deleted and with upserts,
+        so an interrupted batch is simply repeated. Returns the media_keys of the moved tweets.
+    '''
+    archive = database[db_details['tweets_archive_collection']]
+    Database.bulk_write(archive, [ReplaceOne({"id": tweet['id']}, dict(tweet, archived=datetime.now()), upsert=True) for tweet in tweets],
+                        ordered=False, request_name=request_name)
+
+    database[db_details['tweets_collection']].delete_many({"id": {"$in": [tweet['id'] for tweet in tweets]}})
+
+    return set(media_key for tweet in tweets for media_key in tweet.get('attachments', {}).get('media_keys', []))
+
+def prune_media(database, db_details, media_keys):
+    '''
+        Deletes the media that no stored tweet references anymore, together with their entries in the media-rollup.
+    '''
+    if not media_keys:
+        return 0
+
+    tweets_collection = database[db_details['tweets_collection']]
+    referenced = set(media_key for tweet in tweets_collection.find({"attachments.media_keys": {"$in": list(media_keys)}}, projection={'_id': False, 'attachments.media_keys': True})
+                     for media_key in tweet['attachments']['media_keys'])
+
+    orphans = list(set(media_keys) - referenced)
+    if not orphans:
+        return 0
+
+    database[db_details['media_rollup_collection']].delete_many({"media_key": {"$in": orphans}})
+    return database[db_details['media_collection']].delete_many({"media_key": {"$in": orphans}}).deleted_count
+
+def next_batch(tweets_collection, request_name, request_policy):
+    # the whole tweet is only needed when it can be archived
+    projection = {'_id': False} if request_policy['mode'] == 'archive' else {'_id': False, 'id': True, 'requests': True, 'created_at': True}
+    return list(tweets_collection.find(expired_filter(request_name, request_policy), projection=projection,
+                                       sort=[("created_at", ASCENDING)], limit=request_policy['batch_size']))
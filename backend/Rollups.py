@@ -0,0 +1,112 @@
+from datetime import datetime
+from pymongo import UpdateOne, ASCENDING, DESCENDING
+from backend import Database, config
+import calendar
+
+def bucket(created_at, bucket_hours):
+    '''
+        Start of the time-bucket (UTC) that contains the Twitter-timestamp "created_at".
+    '''
+    timestamp = calendar.timegm(datetime.strptime(created_at, '%Y-%m-%dT%H:%M:%S.%fZ').timetuple())
+    return datetime.utcfromtimestamp(timestamp - timestamp % int(bucket_hours * 3600))
+
+def fold_rollups(tweets, bucket_hours):
+    '''
+        Folds a batch of tweets into the hashtag-counts per time-bucket and the media per hashtag.
+        Like fold_user_statistics() a hashtag is counted once per tweet.
+    '''
+    hashtags = {}
+    media = {}
+    for tweet in tweets:
+        if not 'hashtags' in tweet.get('entities', {}):
+            continue
+
+        tweet_bucket = bucket(tweet['created_at'], bucket_hours)
+        for tag in set(tag_data['tag'] for tag_data in tweet['entities']['hashtags']):
+            hashtag = hashtags.setdefault((tweet_bucket, tag), {"count": 0, "last_used": tweet['created_at']})
+            hashtag['count'] += 1
+            hashtag['last_used'] = max(hashtag['last_used'], tweet['created_at'])
+
+            for media_key in tweet.get('attachments', {}).get('media_keys', []):
+                media[(tag, media_key)] = tweet['created_at']
+
+    return hashtags, media
+
+def update_rollups(request_name, tweets, authors, db_details):
+    '''
+        Adds a batch of NEW tweets to the rollups of the request, "authors" is the result of AsyncTasks.fold_user_statistics().
+        Every rollup-document is changed with $inc/$max, so batches of concurrent tasks add up.
+    '''
+    database = Database.get_database(db_details)
+    hashtags, media = fold_rollups(tweets, config.rollups['bucket_hours'])
+
+    user_bulk = [UpdateOne({"request": request_name, "user_id": author_id},
+                           {"$inc": {"score": author['score'], "count": author['count']}, "$max": {"last_used": author['last_used']}}, upsert=True)
+                 for author_id, author in authors.items()]
+
+    hashtag_bulk = [UpdateOne({"request": request_name, "bucket": tweet_bucket, "tag": tag},
+                              {"$inc": {"count": hashtag['count']}, "$max": {"last_used": hashtag['last_used']}}, upsert=True)
+                    for (tweet_bucket, tag), hashtag in hashtags.items()]
+
+    media_bulk = [UpdateOne({"request": request_name, "tag": tag, "media_key": media_key},
+                            {"$max": {"created_at": created_at}}, upsert=True)
+                  for (tag, media_key), created_at in media.items()]
+
+    for collection, bulk in ((db_details['user_rollup_collection'], user_bulk), (db_details['hashtag_rollup_collection'], hashtag_bulk), (db_details['media_rollup_collection'], media_bulk)):
+        if bulk:
+            Database.bulk_write(database[collection], bulk, ordered=False, request_name=request_name)
+
+def add_scores(request_name, score_diffs, db_details):
+    '''
+        Adds the tweet_score-changes of maintained tweets ({author_id: difference}) to the user-rollup of the request.
+    '''
+    bulk = [UpdateOne({"request": request_name, "user_id": author_id}, {"$inc": {"score": score_diff}}, upsert=True)
+            for author_id, score_diff in score_diffs.items() if score_diff]
+
+    if bulk:
+        database = Database.get_database(db_details)
+        Database.bulk_write(database[db_details['user_rollup_collection']], bulk, ordered=False, request_name=request_name)
+
+def clear(request_name, db_details):
+    database = Database.get_database(db_details)
+    for collection in ('user_rollup_collection', 'hashtag_rollup_collection', 'media_rollup_collection'):
+        database[db_details[collection]].delete_many({"request": request_name})
+
+def top_users(request_name, db_details, limit=10):
+    '''
+        The authors with the highest summed tweet_score in the request, with their user-document (id, username, name).
+    '''
+    database = Database.get_database(db_details)
+    ranking = list(database[db_details['user_rollup_collection']].find({"request": request_name}, projection={'_id': False, 'request': False},
+                                                                       sort=[("score", DESCENDING)], limit=limit))
+
+    users = {user['id']: user for user in database[db_details['users_collection']].find({"id": {"$in": [entry['user_id'] for entry in ranking]}},
+                                                                                       projection={'_id': False, 'id': True, 'username': True, 'name': True})}
+    for entry in ranking:
+        entry['user'] = users.get(entry['user_id'])
+
+    return ranking
+
+def hashtag_frequency(request_name, db_details, since=None, until=None):
+    '''
+        The hashtag-counts of the request per time-bucket, optionally limited to the buckets in [since, until).
+    '''
+    query = {"request": request_name}
+    if since or until:
+        query['bucket'] = {}
+        if since:
+            query['bucket']['$gte'] = since
+        if until:
+            query['bucket']['$lt'] = until
+
+    database = Database.get_database(db_details)
+    return list(database[db_details['hashtag_rollup_collection']].find(query, projection={'_id': False, 'request': False},
+                                                                       sort=[("bucket", ASCENDING), ("count", DESCENDING)]))
+
+def media_for_hashtag(request_name, tag, db_details, limit=50):
+    '''
+        The latest media of the request that was posted with the hashtag.
+    '''
+    database = Database.get_database(db_details)
+    return list(database[db_details['media_rollup_collection']].find({"request": request_name, "tag": tag}, projection={'_id': False, 'request': False},
+                                                                     sort=[("created_at", DESCENDING)], limit=limit))
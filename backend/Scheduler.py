@@ -0,0 +1,82 @@
+from pymongo.errors import DuplicateKeyError
+from backend import Metrics
+import time
+
+class RateLimitScheduler:
+    '''
+        Token-bucket for the calls to a Twitter-endpoint, shared by all requests and processes through a state-document in MongoDB.
+        The bucket is refilled from the rate-limit headers (Tweets.RateLimit) of every response, so it always follows Twitter's own count.
+        Ask acquire() before every call: 0 means the call may run now, otherwise the call should be delayed by the returned seconds.
+    '''
+    def __init__(self, collection, key='twitter_search') -> None:
+        self.collection = collection
+        self.key = key
+
+    def acquire(self):
+        now = time.time()
+        state = self.collection.find_one_and_update({"_id": self.key, "remaining": {"$gt": 0}, "reset": {"$gt": now}},
+                                                    {"$inc": {"remaining": -1}},
+                                                    projection={'_id': True})
+        if state:
+            return 0
+
+        state = self.collection.find_one({"_id": self.key})
+
+        # no rate-limit known yet or the window is over: the next response refills the bucket
+        if (not state) or (state['reset'] <= now) or (state['remaining'] > 0):
+            return 0
+
+        return state['reset'] - now
+
+    def wait(self, max_wait):
+        '''
+            Blocks until the call may run, if that is within "max_wait" seconds, and returns 0.
+            Otherwise it doesn't block and returns the seconds the call has to be deferred.
+        '''
+        wait = self.acquire()
+        if wait > max_wait:
+            return wait
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return 0
+
+    def update(self, ratelimit):
+        '''
+            Stores the rate-limit headers of a response. Headers of an older window are ignored,
+            within the same window the lowest "remaining" wins, because the responses of concurrent calls arrive in any order.
+        '''
+        if (ratelimit.Remaining is None) or (ratelimit.ResetIn is None):
+            return
+
+        state = {"remaining": int(ratelimit.Remaining), "reset": int(ratelimit.ResetIn), "updated": time.time()}
+        Metrics.set_gauge('twitter_ratelimit_remaining', state['remaining'], 'Calls left in the current rate-limit window, as of the last response of this process.')
+        Metrics.set_gauge('twitter_ratelimit_reset', state['reset'], 'End of the current rate-limit window as unix-timestamp.')
+        if ratelimit.EndpointLimit is not None:
+            state['limit'] = int(ratelimit.EndpointLimit)
+
+        result = self.collection.update_one({"_id": self.key, "reset": {"$lt": state['reset']}}, {"$set": state})
+        if result.matched_count:
+            return
+
+        result = self.collection.update_one({"_id": self.key, "reset": state['reset']}, {"$min": {"remaining": state['remaining']}})
+        if result.matched_count:
+            return
+
+        try:
+            self.collection.insert_one(dict(state, _id=self.key))
+        except DuplicateKeyError:
+            # another process stored a newer window in the meantime
+            pass
+
+    def toJSON(self):
+        state = self.collection.find_one({"_id": self.key}, projection={'_id': False})
+        if not state:
+            return {}
+
+        state['wait'] = max(0, state['reset'] - time.time()) if state['remaining'] <= 0 else 0
+        return state
+
+def get_scheduler(database, db_details):
+    return RateLimitScheduler(database[db_details['state_collection']])
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from datetime import datetime
+import threading
+import uuid
+from pymongo.errors import BulkWriteError
+from backend import Database
+
+MAX_BATCHES = 16
+DUPLICATE_KEY = 11000
+
+class SharedWork:
+    '''
+        The work that the pulls of one batch share: a document (tweet, user, media) that several requests return is written only once.
+        The $addToSet of the request-name is still done for every request.
+        The claims are stored in the shared_work-collection, so the tasks of a batch that run in another process (e.g. another Lambda-invocation)
+        see them too. The collection expires them after Database.SHARED_WORK_TTL seconds.
+    '''
+    def __init__(self, batch_id, collection) -> None:
+        self.batch_id = batch_id
+        self.collection = collection
+        self.owners = {}
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    def claim_many(self, kind, keys, owner):
+        '''
+            Returns the keys of the documents that "owner" (a request-name) is the first of the batch to claim, that owner enriches and writes them.
+            Asking again with the same owner returns the keys again. One insert_many for the keys this process doesn't know yet,
+            the duplicate key errors are the documents another request claimed first.
+        '''
+        with self.lock:
+            unknown = [key for key in dict.fromkeys(keys) if not (kind, key) in self.owners]
+
+        if unknown:
+            ids = {'{}:{}:{}'.format(self.batch_id, kind, key): key for key in unknown}
+            claimed = dict.fromkeys(unknown, owner)
+            try:
+                self.collection.insert_many([{'_id': claim_id, 'owner': owner, 'created': datetime.now()} for claim_id in ids], ordered=False)
+            except BulkWriteError as error:
+                if any(write_error['code'] != DUPLICATE_KEY for write_error in error.details['writeErrors']):
+                    raise
+
+                taken = [write_error['op']['_id'] for write_error in error.details['writeErrors']]
+                for claim in self.collection.find({'_id': {'$in': taken}}):
+                    claimed[ids[claim['_id']]] = claim['owner']
+
+            with self.lock:
+                for key, key_owner in claimed.items():
+                    self.owners.setdefault((kind, key), key_owner)
+
+        with self.lock:
+            mine = set(key for key in keys if self.owners[(kind, key)] == owner)
+            self.skipped += len(set(keys) - mine)
+
+        return mine
+
+    def claim(self, kind, key, owner):
+        # True when "owner" is the first of the batch to claim the document
+        return key in self.claim_many(kind, [key], owner)
+
+    def toJSON(self):
+        return {'batch_id': self.batch_id, 'documents': len(self.owners), 'skipped': self.skipped}
+
+_batches = OrderedDict()
+_batches_lock = threading.Lock()
+
+def _remember(shared_work):
+    with _batches_lock:
+        shared_work = _batches.setdefault(shared_work.batch_id, shared_work)
+        # the tasks of a batch can outlive the batch-call, so the latest batches are kept instead of removing them at the end
+        while len(_batches) > MAX_BATCHES:
+            _batches.popitem(last=False)
+
+    return shared_work
+
+def _collection(db_details):
+    return Database.get_database(db_details)[db_details['shared_work_collection']]
+
+def start_batch(db_details):
+    return _remember(SharedWork(uuid.uuid4().hex, _collection(db_details)))
+
+def get_shared_work(request_info, db_details):
+    '''
+        Returns the SharedWork of the batch the request belongs to, or None.
+        A task that runs in another process than the batch-call gets a SharedWork on the same claims.
+    '''
+    batch_id = request_info.get('batch_id')
+    if not batch_id:
+        return None
+
+    with _batches_lock:
+        if batch_id in _batches:
+            return _batches[batch_id]
+
+    return _remember(SharedWork(batch_id, _collection(db_details)))
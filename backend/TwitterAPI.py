@@ -1,6 +1,110 @@
+from requests.adapters import HTTPAdapter
+import os
 import requests
+import threading
 import urllib.parse
 
+try:
+    import orjson
+except ImportError:
+    # without orjson the responses are decoded by requests, with the json-module of the standard library
+    orjson = None
+
+DEFAULT_TIMEOUT = (5, 30) # (connect, read) in seconds
+DEFAULT_POOL_SIZE = 10
+
+# the fields the backend itself needs, they are kept by every projection
+REQUIRED_FIELDS = {
+    "tweet": ['id', 'author_id', 'created_at', 'public_metrics', 'entities.hashtags', 'attachments.media_keys'],
+    "user": ['id', 'username'],
+    "media": ['media_key']
+}
+
+# the sections of a search-response, with the name of their fields in the "fields"-setting
+SECTIONS = [(('data',), 'tweet'), (('includes', 'users'), 'user'), (('includes', 'media'), 'media')]
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+def get_session(pool_size=DEFAULT_POOL_SIZE):
+    '''
+        Returns the HTTP-session that all Tweets-objects of this process share.
+        The session keeps the connections to the Twitter-API alive, so DNS-, TCP- and TLS-setup are only paid once.
+    '''
+    global _session, _session_pid
+    # a forked process can't share the connections of its parent
+    if (_session is None) or (_session_pid != os.getpid()):
+        with _session_lock:
+            if (_session is None) or (_session_pid != os.getpid()):
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({"Accept-Encoding": "gzip"})
+                _session = session
+                _session_pid = os.getpid()
+
+    return _session
+
+def with_page_size(parameters, page_size):
+    '''
+        Returns the search-parameters with max_results set to "page_size", an existing max_results is replaced.
+    '''
+    if not page_size:
+        return parameters
+
+    fields = [field for field in (parameters or '').split('&') if field and not field.startswith('max_results=')]
+    return '&'.join(fields + ['max_results={}'.format(page_size)])
+
+def decode(response):
+    if orjson is not None:
+        return orjson.loads(response.content)
+
+    return response.json()
+
+def pick(document, paths):
+    '''
+        Copies the fields in "paths" from the document, a path like "entities.hashtags" copies only that part of a nested field.
+    '''
+    picked = {}
+    for path in paths:
+        source = document
+        target = picked
+        keys = path.split('.')
+        for key in keys[:-1]:
+            if not isinstance(source.get(key), dict):
+                source = {}
+                break
+
+            source = source[key]
+            target = target.setdefault(key, {})
+
+        if keys[-1] in source:
+            target[keys[-1]] = source[keys[-1]]
+
+    return picked
+
+def project(payload, fields):
+    '''
+        Trims the tweets and includes of a search-response to the fields the request keeps,
+        e.g. {"tweet": ["text", "lang"], "user": ["name", "profile_image_url"], "media": ["url", "preview_image_url"]}.
+        REQUIRED_FIELDS are always kept, a section missing in "fields" is kept completely.
+    '''
+    for path, section in SECTIONS:
+        if not section in fields:
+            continue
+
+        parent = payload
+        for key in path[:-1]:
+            parent = parent.get(key, {})
+
+        if path[-1] in parent:
+            paths = REQUIRED_FIELDS[section] + [field for field in fields[section] if not field in REQUIRED_FIELDS[section]]
+            parent[path[-1]] = [pick(document, paths) for document in parent[path[-1]]]
+
+    return payload
+
 class Tweets:
     class RateLimit:
         def __init__(self) -> None:
@@ -11,7 +115,7 @@ class Tweets:
         def toJSON(self):
             return {'EndpointLimit': self.EndpointLimit, 'Remaining': self.Remaining, 'ResetIn': self.ResetIn}
 
-    def __init__(self, bearer=None, tweet_search_uri=None, search_query=None, search_parameters=None, since_tweet_id=None, until_tweet_id=None, next_token=None) -> None:
+    def __init__(self, bearer=None, tweet_search_uri=None, search_query=None, search_parameters=None, since_tweet_id=None, until_tweet_id=None, next_token=None, timeout=DEFAULT_TIMEOUT, session=None, fields=None) -> None:
         self.bearer = bearer
         self.tweet_search_uri = tweet_search_uri
         self.search_query = search_query
@@ -19,7 +123,11 @@ class Tweets:
         self.since_tweet_id = since_tweet_id
         self.until_tweet_id = until_tweet_id
         self.next_token = next_token
+        self.timeout = timeout
+        self.session = session
+        self.fields = fields
         self.url = None
+        self.status_code = None
         self.data = None
         self.is_json = False
         self.is_error = False
@@ -66,36 +174,76 @@ class Tweets:
         if not self.url:
             raise Exception('The URL is missing. Please execute "create_url()" first.')
 
-        response = requests.request("GET", self.url, headers=self.headers)
+        self.is_json = False
+        self.is_error = False
+        self.is_success = False
+        self.status_code = None
+
+        if not self.session:
+            self.session = get_session()
+
+        try:
+            response = self.session.get(self.url, headers=self.headers, timeout=self.timeout)
+        except requests.RequestException as error:
+            self.is_error = True
+            self.data = {'status': 0, 'detail': '{}: {}'.format(type(error).__name__, error)}
+            self.is_json = True
+            return
+
+        self.status_code = response.status_code
         if response.status_code != 200:            
             self.is_error = True
             try:
-                self.data = response.json()
+                self.data = decode(response)
                 self.is_json = True
             except:
                 self.data = response.text
         else:
             self.is_success = True
             try:
-                self.data = response.json()
+                self.data = decode(response)
                 self.is_json = True
             except:
                 self.data = response.text
 
-        if response.headers['x-rate-limit-limit']:
+            if self.is_json and self.fields:
+                self.data = project(self.data, self.fields)
+
+        if response.headers.get('x-rate-limit-limit'):
             self.ratelimit.EndpointLimit = response.headers['x-rate-limit-limit']
 
-        if response.headers['x-rate-limit-remaining']:
+        if response.headers.get('x-rate-limit-remaining'):
             self.ratelimit.Remaining = response.headers['x-rate-limit-remaining']
 
-        if response.headers['x-rate-limit-reset']:
+        if response.headers.get('x-rate-limit-reset'):
             self.ratelimit.ResetIn = response.headers['x-rate-limit-reset']
 
+    @property
+    def is_rate_limited(self):
+        return self.status_code == 429
+
     def getdata(self):
         self.create_headers()
         self.create_url()
         self.connect_to_endpoint()
 
+    def pages(self):
+        '''
+            Generator over the pages of the search, starting at the current next_token.
+            A page is only downloaded when the previous one was consumed. While a page is handled, next_token already points to the page after it.
+            The generator stops after the last page or at the first error, is_error and data tell what went wrong.
+        '''
+        while True:
+            self.getdata()
+            if not (self.is_success and self.is_json):
+                return
+
+            self.next_token = self.data['meta'].get('next_token')
+            yield self.data
+
+            if not self.next_token:
+                return
+
 def main():
     test = Tweets(tweet_search_uri='https://www.twitter.com/')
     test.getdata()
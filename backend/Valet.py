@@ -0,0 +1,397 @@
+from pymongo import ASCENDING
+from datetime import datetime, timedelta
+from backend import AsyncTasks, TwitterAPI, DataProcessor, Database, Metrics, Retention, Scheduler, SharedWork, config
+from backend.RequestState import RequestState
+from concurrent.futures import ThreadPoolExecutor
+import time
+import uuid
+
+PROGRESS_FIELDS = ['name', 'user', 'job', 'status', 'update_status', 'active', 'active_new', 'active_update',
+                   'last_pull_started', 'last_pull_finished', 'last_pull_tweets_downloaded',
+                   'last_update_pull_started', 'last_update_pull_finished', 'last_update_pull_tweets_downloaded', 'pull_metrics']
+
+def error_response(desc):
+    payload = { "success": False, "error": desc}
+    return payload
+
+def deferred_response(wait, scheduler):
+    payload = { "success": True, "deferred": True, "retry_after": round(wait), "tweets_new": 0, "tweets_maintained": 0, "ratelimit_info": scheduler.toJSON() }
+    return payload
+
+def isoformat(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    return value
+
+def throughput(tweet_count, started, finished):
+    if (not started) or (not finished) or (finished < started) or (tweet_count is None):
+        return None
+
+    seconds = (finished - started).total_seconds()
+    return { "tweets": tweet_count, "seconds": round(seconds, 3), "tweets_per_second": round(tweet_count / seconds, 2) if seconds else None }
+
+def enqueue(request_info):
+    '''
+        Validates the request and starts the pull as a task (AsyncTasks.run_pull()), the progress can be polled with the returned job_id.
+        As long as a job of the request is queued or running, its job_id is returned instead of starting a second pull.
+        Jobs older than config.valet['job_timeout_seconds'] are treated as dead.
+    '''
+    db = Database.get_database(config.mongodb)
+    api_requests = db[config.mongodb['request_collection']]
+    request_filter = {"name": request_info['name'], "user": request_info['user']}
+
+    if not api_requests.find_one(request_filter, projection={'_id': True}):
+        return error_response(desc="The request {} does not exists.".format(request_info['name']))
+
+    job = {"id": uuid.uuid4().hex, "state": "queued", "queued": datetime.now()}
+    stale_from = datetime.now() - timedelta(seconds=config.valet['job_timeout_seconds'])
+    claimed = api_requests.find_one_and_update(dict(request_filter, **{"$or": [{"job.state": {"$nin": ["queued", "running"]}}, {"job.queued": {"$lt": stale_from}}]}),
+                                               {"$set": {"job": job}},
+                                               projection={'_id': True})
+    if not claimed:
+        running_job = api_requests.find_one(request_filter, projection={'_id': False, 'job': True})['job']
+        return { "success": True, "job_id": running_job['id'], "state": running_job['state'] }
+
+    AsyncTasks.run_pull(request_info, job['id'])
+
+    return { "success": True, "job_id": job['id'], "state": job['state'] }
+
+def progress(job_id):
+    '''
+        Returns the progress of a pull started by enqueue(): the job, the status-fields of the request and the throughput of the finished steps.
+    '''
+    db = Database.get_database(config.mongodb)
+    api_requests = db[config.mongodb['request_collection']]
+
+    request = api_requests.find_one({"job.id": job_id}, projection={field: True for field in PROGRESS_FIELDS})
+    if not request:
+        return error_response(desc="The job {} does not exists.".format(job_id))
+
+    payload = { "success": True }
+    for field in PROGRESS_FIELDS:
+        payload[field] = isoformat(request.get(field))
+
+    payload['job'] = {key: isoformat(value) for key, value in request['job'].items()}
+
+    payload['throughput'] = {
+        "new": throughput(request.get('last_pull_tweets_downloaded'), request.get('last_pull_started'), request.get('last_pull_finished')),
+        "update": throughput(request.get('last_update_pull_tweets_downloaded'), request.get('last_update_pull_started'), request.get('last_update_pull_finished'))
+    }
+
+    return payload
+
+def pull_batch(request_infos):
+    '''
+        Runs the pulls of many saved requests, at most config.valet['batch_concurrency'] at the same time.
+        All pulls share the HTTP-session, the MongoClient and the oEmbed-cache of this process,
+        and a tweet that several requests return is enriched and written only once (see SharedWork).
+        A request that is in the batch more than once is pulled once, every entry gets its result.
+    '''
+    shared_work = SharedWork.start_batch(config.mongodb)
+    unique_infos = {}
+    for request_info in request_infos:
+        unique_infos.setdefault((request_info['name'], request_info['user']), request_info)['batch_id'] = shared_work.batch_id
+
+    def pull_one(request_info):
+        try:
+            return pull(request_info)
+        except Exception as error:
+            return error_response(desc='{}: {}'.format(type(error).__name__, error))
+
+    with ThreadPoolExecutor(max_workers=config.valet['batch_concurrency']) as pool:
+        unique_results = dict(zip(unique_infos, pool.map(pull_one, unique_infos.values())))
+
+    results = []
+    for request_info in request_infos:
+        result = dict(unique_results[(request_info['name'], request_info['user'])])
+        result['name'] = request_info['name']
+        result['user'] = request_info['user']
+        results.append(result)
+
+    return { "success": all(result['success'] for result in results), "results": results, "shared_work": shared_work.toJSON() }
+
+def continue_chain(request_info, request_state, page):
+    '''
+        Starts the download-chain of the pages after the first one, the first page has to be committed already.
+        The chain is checkpointed before it starts, see AsyncTasks.checkpoint_page().
+        With config.pipeline['streaming'] the chain runs in one invocation (AsyncTasks.stream_tweets()), only the next_token is passed to the task.
+    '''
+    page['chain_id'] = uuid.uuid4().hex
+    AsyncTasks.checkpoint_page(request_state, page)
+    request_state.flush()
+
+    if config.pipeline['streaming']:
+        AsyncTasks.stream_tweets(**page)
+    else:
+        AsyncTasks.download_more_tweets(api_bearer=config.twitter['bearer'], api_tweet_search_uri=config.twitter['tweet_search_uri'], **page)
+
+def maintain(request_info, since_id):
+    '''
+        2nd step of a pull: refreshes the public metrics of the tweets in the maintenance-period, up to "since_id" (the newest tweet of the previous pull).
+        It doesn't depend on the 1st step, pull() runs it in a thread next to the 1st step or as a task with config.valet['defer_maintenance'].
+        The maintenance has its own Tweets-client, RequestState and download-chain. Returns the number of tweets of its first page.
+    '''
+    db = Database.get_database(config.mongodb)
+    request_state = RequestState(db[config.mongodb['request_collection']], request_info['name'], request_info['user'])
+    request = request_state.load(projection={'_id': False, 'name': True, 'query': True, 'parameters': True, 'fields': True, 'maintenance_delta': True, 'last_full_maintenance': True})
+    scheduler = Scheduler.get_scheduler(db, config.mongodb)
+
+    tweets_maintained = 0
+    finalize = False
+
+    db_tweets = db[config.mongodb['tweets_collection']]
+    maintenance_from = datetime.today() - timedelta(hours=request['maintenance_delta'])
+    maintenance_filter = {"requests": request['name'], "id": { "$lt": since_id }, "created_at": { "$gte": maintenance_from.isoformat() }}
+
+    ## adaptive maintenance: the period starts at the oldest tweet whose metrics still move,
+    ## tweets that didn't change for config.maintenance['settle_hours'] are only polled by the periodic full maintenance
+    full_maintenance = request.get('last_full_maintenance', datetime.min) < datetime.now() - timedelta(hours=config.maintenance['full_every_hours'])
+    if not full_maintenance:
+        settled_from = datetime.now() - timedelta(hours=config.maintenance['settle_hours'])
+        maintenance_filter['$or'] = [{"metrics_changed": {"$exists": False}}, {"metrics_changed": {"$gte": settled_from}}]
+
+    oldest_tweet_to_maintain = db_tweets.find_one(filter=maintenance_filter,
+                                                projection={'_id': False, 'id': True, 'created_at': True},
+                                                sort=[("id", ASCENDING)]) # ASCENDING comes from pymongo
+
+    ## could be that the maintenance-period doesn't contain any tweets
+    ## when the rate limit is used up, the maintenance is left for the next pull
+    if (not oldest_tweet_to_maintain) or scheduler.wait(config.twitter['ratelimit_max_wait_seconds']):
+        return tweets_maintained
+
+    request_state.set({
+                        'active_update': True, 
+                        'update_status': 'Update Likes & Replies.',
+                        'last_update_pull_started': datetime.now(),
+                        'maintenance_window_hours': round((datetime.utcnow() - datetime.strptime(oldest_tweet_to_maintain['created_at'], '%Y-%m-%dT%H:%M:%S.%fZ')).total_seconds() / 3600, 2)
+                      })
+    if full_maintenance:
+        request_state.set({'last_full_maintenance': datetime.now()})
+
+    # the state has to be written before the maintenance-cycle is started
+    request_state.flush()
+
+    tweets = TwitterAPI.Tweets(bearer=config.twitter['bearer'], tweet_search_uri=config.twitter['tweet_search_uri'], 
+                               search_query=request['query'], search_parameters=AsyncTasks.continuation_parameters(request['parameters']),
+                               since_tweet_id=oldest_tweet_to_maintain['id'], next_token=None, until_tweet_id=str(int(since_id)+1),
+                               timeout=(config.twitter['connect_timeout'], config.twitter['read_timeout']), session=TwitterAPI.get_session(config.twitter['pool_size']),
+                               fields=request.get('fields', config.twitter['fields']))
+    with Metrics.timer('twitter_fetch', request_info['name']):
+        tweets.getdata()
+    scheduler.update(tweets.ratelimit)
+
+    if tweets.is_success and tweets.is_json:
+        json_response = tweets.data
+    else:
+        # e.g. the rate limit was used up in the meantime, the tweets are maintained with the next pull
+        json_response = {'meta': {'result_count': 0}}
+
+    if json_response['meta']['result_count'] > 0:
+        tweets_maintained = json_response['meta']['result_count']
+
+        finalize = not 'next_token' in json_response['meta']
+        DataProcessor.update_existing_data(json_response, request_info, config.mongodb, trigger_refresh=finalize)
+
+        if not finalize:
+            continue_chain(request_info, request_state, {"request_info": request_info,
+                                                         "api_search_query": request['query'],
+                                                         "api_search_parameters": tweets.parameters,
+                                                         "api_since_tweet_id": oldest_tweet_to_maintain['id'],
+                                                         "api_next_token": json_response['meta']['next_token'],
+                                                         "api_tweet_count": json_response['meta']['result_count'],
+                                                         "api_until_tweet_id": tweets.until_tweet_id,
+                                                         "tweet_action": 'update'})
+
+    else:
+        finalize = True
+
+    if finalize:
+        request_state.set({'active_update': False, 'last_update_pull_tweets_downloaded': json_response['meta']['result_count'], 'last_update_pull_finished': datetime.now()})
+
+    Metrics.flush(request_state)
+    request_state.flush()
+
+    return tweets_maintained
+
+def record_maintenance_error(request_state, error):
+    '''
+        Records a failed maintenance in the request-document and returns the error as text.
+        The state that is pending in request_state (e.g. of the 1st step) is written with it.
+    '''
+    description = '{}: {}'.format(type(error).__name__, error)
+    print(f"maintenance failed: {description}")
+
+    request_state.set({'active_update': False, 'update_status': 'Maintenance failed: ' + description})
+    request_state.flush()
+
+    return description
+
+def join_maintenance(maintenance, request_state):
+    '''
+        Waits for the maintenance that pull() started in a thread and returns (tweets_maintained, error).
+    '''
+    if not maintenance:
+        return 0, None
+
+    try:
+        return maintenance.result(), None
+    except Exception as error:
+        return 0, record_maintenance_error(request_state, error)
+
+def pull(request_info):
+    '''
+        Runs a data pull for the saved request {name, user} and returns the payload of the /valet-response.
+        1st step: download & process all new tweets since the last pull.
+        2nd step: refresh the public metrics of the tweets in the maintenance-period, concurrently to the 1st step (see maintain()).
+    '''
+    started = time.perf_counter()
+    warm_start = Database.is_warm(config.mongodb)
+    db = Database.get_database(config.mongodb)
+    api_requests = db[config.mongodb['request_collection']]
+    request_state = RequestState(api_requests, request_info['name'], request_info['user'])
+
+    request = request_state.load() 
+
+    if not request:
+        return error_response(desc="The request {} does not exists.".format(request_info['name']))
+
+    if 'last_pull' in request:
+        request_info['last_pull'] = request['last_pull'].isoformat()
+
+    ## pages that were deferred because of the rate limit are resumed first
+    AsyncTasks.resume_deferred_pages(request, request_state)
+    ## download-chains whose invocation died continue from their last committed page
+    AsyncTasks.resume_checkpoints(request, request_state)
+
+    scheduler = Scheduler.get_scheduler(db, config.mongodb)
+    wait = scheduler.wait(config.twitter['ratelimit_max_wait_seconds'])
+    if wait:
+        return deferred_response(wait, scheduler)
+
+    ## 1st step
+    ## download & process all new tweets since last data pull
+
+    since_tweet_id = request['since_id']
+    twitter_date_thresshold = datetime.today() - timedelta(days=7)
+    if request['last_pull'] < twitter_date_thresshold:
+        since_tweet_id = ''
+
+    request_state.set({
+                        'active_new': True, 
+                        'status': 'Download & process new Tweets.',
+                        'last_pull_started': datetime.now(),
+                        'pull_metrics': {}
+                      })
+    # the state has to be written before the download-cycle is started
+    Metrics.discard(request_info['name'])
+    request_state.flush()
+
+    ## 2nd step
+    ## refresh public metrics of existing tweets, it runs concurrently to the 1st step or as a task (see maintain())
+    maintenance = None
+    maintenance_deferred = False
+    if (request['last_pull'] > twitter_date_thresshold) and (request['FirstRunCompleted']):
+        if request_info.get('defer_maintenance', config.valet['defer_maintenance']):
+            AsyncTasks.run_maintenance(request_info, request['since_id'])
+            maintenance_deferred = True
+        else:
+            pool = ThreadPoolExecutor(max_workers=1)
+            maintenance = pool.submit(maintain, request_info, request['since_id'])
+            pool.shutdown(wait=False)
+
+    try:
+        ## the first page is sized by the volume of the query, the following pages are always full (see AsyncTasks.page_size())
+        first_page_size = AsyncTasks.page_size(request.get('volume'), request['last_pull'])
+        if first_page_size:
+            request_state.set({'volume.first_page_size': first_page_size})
+
+        tweets = TwitterAPI.Tweets(bearer=config.twitter['bearer'], tweet_search_uri=config.twitter['tweet_search_uri'], 
+                                   search_query=request['query'], search_parameters=TwitterAPI.with_page_size(request['parameters'], first_page_size), since_tweet_id=since_tweet_id, next_token=None,
+                                   timeout=(config.twitter['connect_timeout'], config.twitter['read_timeout']), session=TwitterAPI.get_session(config.twitter['pool_size']),
+                                   fields=request.get('fields', config.twitter['fields']))
+    
+        with Metrics.timer('twitter_fetch', request_info['name']):
+            tweets.getdata()
+        scheduler.update(tweets.ratelimit)
+
+        if tweets.is_rate_limited:
+            request_state.set({'active_new': False, 'status': 'Waiting for the Twitter rate limit.'})
+            request_state.flush()
+            return deferred_response(scheduler.acquire(), scheduler)
+
+        if tweets.is_success:
+            if tweets.is_json:
+                json_response = tweets.data
+            else:
+                return error_response(desc="Something went wrong. API did not return a JSON-formatted file.")
+
+        if tweets.is_error:
+            print(tweets.data)
+            if ('detail' in tweets.data) and ('status' in tweets.data):
+                return error_response(desc="Something went wrong. API-response: {} - {}".format(tweets.data['status'], tweets.data['detail']))
+            else:
+                return error_response(desc="Something went wrong. API did not return a JSON-formatted file.")
+
+        newest_id = ''
+        tweet_count = 0
+        finalize = False
+
+        if json_response['meta']['result_count'] > 0:
+            newest_id = json_response['meta']['newest_id']
+            tweet_count = json_response['meta']['result_count']
+
+            if AsyncTasks.page_already_held(json_response, request['name'], config.mongodb):
+                # e.g. a concurrent pull of the request already downloaded the tweets of this and the following pages
+                request_state.inc({'volume.early_stops': 1})
+                tweet_count = 0
+                finalize = True
+            else:
+                # handle first page received
+                DataProcessor.process_new_data(request_info, json_response, config.mongodb)
+
+                if 'next_token' in json_response['meta']:
+                    continue_chain(request_info, request_state, {"request_info": request_info,
+                                                                 "api_search_query": request['query'],
+                                                                 "api_search_parameters": AsyncTasks.continuation_parameters(request['parameters']),
+                                                                 "api_since_tweet_id": since_tweet_id,
+                                                                 "api_next_token": json_response['meta']['next_token'],
+                                                                 "api_tweet_count": json_response['meta']['result_count'],
+                                                                 "api_until_tweet_id": None,
+                                                                 "tweet_action": 'new'})
+                else:
+                    finalize = True
+
+        else:
+            finalize = True
+    
+        if finalize:
+            request_state.set({'active_new': False, 'last_pull_tweets_downloaded': json_response['meta']['result_count'], 'last_pull_finished': datetime.now()})
+            AsyncTasks.record_volume(request_state, request.get('volume'), request['last_pull'], json_response['meta']['result_count'])
+
+        request_state.set({"last_pull": datetime.now()})
+        if newest_id:
+            request_state.set({"since_id": newest_id})
+
+    finally:
+        # the response is sent when both steps are done, a failed maintenance doesn't discard the state of the 1st step
+        tweets_maintained, maintenance_error = join_maintenance(maintenance, request_state)
+
+    if (request['last_pull'] > twitter_date_thresshold) and (not request['FirstRunCompleted']):
+        request_state.set({"FirstRunCompleted": True})
+
+    ## compaction of the tweets that fell out of the retention-period, at most once per interval_hours of the request's retention-policy
+    request_policy = Retention.policy(request)
+    if request_policy['enabled'] and (request.get('last_retention_started', datetime.min) < datetime.now() - timedelta(hours=request_policy['interval_hours'])):
+        request_state.set({'last_retention_started': datetime.now()})
+        AsyncTasks.apply_retention(request_info, config.mongodb)
+
+    Metrics.record('valet_pull', request_info['name'], seconds=time.perf_counter() - started)
+    Metrics.flush(request_state)
+    request_state.flush()
+
+    mongodb_info = Database.client_info(config.mongodb).toJSON()
+    mongodb_info['warm_start'] = warm_start
+
+    return { "success": True, "tweets_new": tweet_count, "tweets_maintained": tweets_maintained, "maintenance_deferred": maintenance_deferred, "maintenance_error": maintenance_error,
+             "ratelimit_info": tweets.ratelimit.toJSON(), "mongodb_info": mongodb_info }
@@ -4,11 +4,79 @@ mongodb = {
   "request_collection": "requests",
   "tweets_collection": "tweets",
   "media_collection": "media",
-  "users_collection": "users"
+  "users_collection": "users",
+  "max_pool_size": 10,
+  "min_pool_size": 0,
+  "ensure_indexes": True,
+  "state_collection": "state",
+  "user_rollup_collection": "rollup_users",
+  "hashtag_rollup_collection": "rollup_hashtags",
+  "media_rollup_collection": "rollup_media",
+  "tweets_archive_collection": "tweets_archive",
+  "shared_work_collection": "shared_work"
 }
 twitter = {
   "bearer": "",
   "tweet_search_uri": "https://api.twitter.com/2/tweets/search/recent?",
   "oembed": "https://publish.twitter.com/oembed?dnt=true&url=",
-  "twitter_url_root": "https://twitter.com/"  
+  "twitter_url_root": "https://twitter.com/",
+  "connect_timeout": 5,
+  "read_timeout": 30,
+  "pool_size": 10,
+  "ratelimit_max_wait_seconds": 20,
+  "fields": None
+}
+oembed = {
+  "cache_size": 10000,
+  "cache_ttl_seconds": 86400,
+  "concurrency": 10,
+  "timeout_seconds": 10,
+  "retries": 2,
+  "backoff_seconds": 0.5
+}
+valet = {
+  "async": False,
+  "job_timeout_seconds": 900,
+  "batch_concurrency": 4,
+  "defer_maintenance": False
+}
+tasks = {
+  "executor": "zappa",
+  "max_workers": 4
+}
+pipeline = {
+  "streaming": False,
+  "queue_size": 2,
+  "checkpoint_timeout_seconds": 900
+}
+paging = {
+  "adaptive": True,
+  "min_page_size": 10,
+  "max_page_size": 100,
+  "volume_smoothing": 0.3,
+  "early_stop": True
+}
+maintenance = {
+  "settle_hours": 6,
+  "full_every_hours": 24
+}
+rollups = {
+  "enabled": True,
+  "bucket_hours": 1,
+  "embedded_user_statistics": True
+}
+retention = {
+  "enabled": False,
+  "interval_hours": 24,
+  "after_days": 30,
+  "mode": "slim",
+  "batch_size": 500,
+  "max_batches": 20,
+  "prune_media": True,
+  "compact_fields": ["tweet_html", "author", "media", "entities.urls", "entities.mentions", "entities.annotations", "context_annotations"]
+}
+synergy = {
+  "debounce_seconds": 60,
+  "min_change": 36,
+  "server_side": False
 }
@@ -1,28 +1,132 @@
+from collections import OrderedDict
 import aiohttp
 import asyncio
+import threading
+import time
 import urllib
 
-async def get_embedded_html(tweets, config):
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+class EmbedCache:
+    '''
+        In-process cache for the embedded html of tweets, keyed by the tweet-URL.
+        Entries expire after "ttl" seconds, the least recently used entry is evicted when "max_size" is reached.
+    '''
+    def __init__(self, max_size, ttl) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                html, expires = self.entries[key]
+                if expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return html
+
+                del self.entries[key]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, html):
+        with self.lock:
+            self.entries[key] = (html, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def toJSON(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+_cache = None
+
+def get_cache(config):
+    global _cache
+    if _cache is None:
+        _cache = EmbedCache(max_size=config.oembed['cache_size'], ttl=config.oembed['cache_ttl_seconds'])
+
+    return _cache
+
+def is_embedded_html(html):
+    # error messages stored in tweet_html start with the http-status, the embedded html is a <blockquote>
+    return bool(html) and html.startswith('<')
+
+def tweet_url(tweet, config):
+    return config.twitter['twitter_url_root'] + tweet['author'][0]['username'] + '/status/' + tweet['id']
+
+async def get_embedded_html(tweets, config, tweets_collection=None):
+    '''
+        Adds the embedded html ("tweet_html") to every tweet of the payload.
+        The html is looked up in the in-process cache first, then in the tweets that are already stored in "tweets_collection".
+        Only the remaining tweets are requested from the oEmbed-API, with at most config.oembed['concurrency'] requests at the same time.
+    '''
     if 'data' in tweets:
+            cache = get_cache(config)
+
+            missing = {}
+            for tweet in tweets['data']:
+                if not 'author' in tweet:
+                    continue
+
+                tweet_requested = tweet_url(tweet, config)
+                html = cache.get(tweet_requested)
+                if html:
+                    tweet['tweet_html'] = html
+                else:
+                    missing[tweet['id']] = (tweet, tweet_requested)
+
+            if missing and (tweets_collection is not None):
+                for stored_tweet in tweets_collection.find({"id": {"$in": list(missing)}, "tweet_html": {"$exists": True}}, projection={'_id': False, 'id': True, 'tweet_html': True}):
+                    if is_embedded_html(stored_tweet['tweet_html']):
+                        tweet, tweet_requested = missing.pop(stored_tweet['id'])
+                        tweet['tweet_html'] = stored_tweet['tweet_html']
+                        cache.put(tweet_requested, stored_tweet['tweet_html'])
 
-            async with aiohttp.ClientSession() as session:
+            if not missing:
+                return
+
+            semaphore = asyncio.Semaphore(config.oembed['concurrency'])
+            timeout = aiohttp.ClientTimeout(total=config.oembed['timeout_seconds'])
+            async with aiohttp.ClientSession(timeout=timeout) as session:
 
                 tasks = []
-                for tweet in tweets['data']:
-                    tweet_requested = config.twitter['twitter_url_root'] + tweet['author'][0]['username'] + '/status/' + tweet['id']
+                for tweet, tweet_requested in missing.values():
                     url = config.twitter['oembed'] + urllib.parse.quote(tweet_requested)
-                    tasks.append(asyncio.ensure_future(get_data(session, url, tweet)))
+                    tasks.append(asyncio.ensure_future(get_data(session, url, tweet, semaphore, config)))
 
                 await asyncio.gather(*tasks)
 
+            for tweet, tweet_requested in missing.values():
+                if is_embedded_html(tweet.get('tweet_html')):
+                    cache.put(tweet_requested, tweet['tweet_html'])
+
+
+async def get_data(session, url, tweet, semaphore, config):
+    retries = config.oembed['retries']
+    for attempt in range(retries + 1):
+        try:
+            async with semaphore:
+                async with session.get(url) as resp:
+                    if resp.ok:
+                        response_content = await resp.json()
+                        try:
+                            tweet['tweet_html'] = response_content['html']
+                        except:
+                            tweet['tweet_html'] = str(resp.status) + ': ' + resp.reason + ' - error loading tweet ' + url
+                        return
+
+                    tweet['tweet_html'] = str(resp.status) + ': ' + resp.reason + ' - error loading tweet ' + url
+                    if not resp.status in RETRY_STATUS:
+                        return
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            tweet['tweet_html'] = '000: ' + type(error).__name__ + ' - error loading tweet ' + url
 
-async def get_data(session, url, tweet):
-    async with session.get(url) as resp:
-        if resp.ok:
-            response_content = await resp.json()
-            try:
-                tweet['tweet_html'] = response_content['html']
-            except:
-                tweet['tweet_html'] = str(resp.status) + ': ' + resp.reason + ' - error loading tweet ' + url
-        else:
-            tweet['tweet_html'] = str(resp.status) + ': ' + resp.reason + ' - error loading tweet ' + url
+        if attempt < retries:
+            await asyncio.sleep(config.oembed['backoff_seconds'] * (2 ** attempt))
@@ -0,0 +1,22 @@
+'''
+    Offline benchmarks of the backend. Without a backend/config.py (the deployment-config) they run with the settings of backend/config_template.py.
+'''
+import importlib
+import sys
+
+def use_config_template():
+    '''
+        Makes backend.config the module backend/config_template.py, unless a backend/config.py exists.
+    '''
+    try:
+        importlib.import_module('backend.config')
+    except ModuleNotFoundError as error:
+        if error.name != 'backend.config':
+            raise
+
+        import backend
+        from backend import config_template
+        sys.modules['backend.config'] = config_template
+        backend.config = config_template
+
+use_config_template()
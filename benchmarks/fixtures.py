@@ -0,0 +1,168 @@
+'''
+    Fixtures for the offline benchmarks: tweets, users and media in the shape of the Twitter API v2 search-endpoint,
+    and a local HTTP-server that replays them as search-pages and oEmbed-responses.
+'''
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import json
+import random
+import threading
+import time
+
+PAGE_SIZE = 100
+
+class Fixture:
+    '''
+        The tweets (newest first) with their users and media, like the search-endpoint would return them over all pages.
+    '''
+    def __init__(self, tweets, users, media) -> None:
+        self.tweets = sorted(tweets, key=lambda tweet: int(tweet['id']), reverse=True)
+        self.users = users
+        self.media = media
+
+    def page(self, since_id=None, until_id=None, start=0, size=PAGE_SIZE):
+        tweets = self.tweets
+        if since_id:
+            tweets = [tweet for tweet in tweets if int(tweet['id']) > int(since_id)]
+        if until_id:
+            tweets = [tweet for tweet in tweets if int(tweet['id']) < int(until_id)]
+
+        data = [json.loads(json.dumps(tweet)) for tweet in tweets[start:start + size]]
+        meta = {"result_count": len(data)}
+        if not data:
+            return {"meta": meta}
+
+        meta['newest_id'] = data[0]['id']
+        meta['oldest_id'] = data[-1]['id']
+        if start + size < len(tweets):
+            meta['next_token'] = str(start + size)
+
+        author_ids = sorted(set(tweet['author_id'] for tweet in data))
+        media_keys = [media_key for tweet in data for media_key in tweet.get('attachments', {}).get('media_keys', [])]
+        includes = {"users": [dict(self.users[author_id]) for author_id in author_ids if author_id in self.users],
+                    "media": [dict(self.media[media_key]) for media_key in media_keys if media_key in self.media]}
+
+        return {"data": data, "includes": includes, "meta": meta}
+
+    def pages(self, size=PAGE_SIZE):
+        return [self.page(start=start, size=size) for start in range(0, len(self.tweets), size)]
+
+def synthetic(count, seed=42, authors=None, hashtags=50):
+    '''
+        Generates "count" tweets of the last 7 days, every tweet has one photo and up to three hashtags.
+    '''
+    randomizer = random.Random(seed)
+    authors = authors or max(1, count // 10)
+    now = datetime.utcnow()
+
+    tweets = []
+    media = {}
+    for i in range(count):
+        created_at = now - timedelta(seconds=i * (6 * 24 * 3600) // max(count, 1))
+        media_key = '3_{}'.format(1500000000000000000 - i)
+        tweets.append({
+            "id": str(1500000000000000000 - i),
+            "author_id": str(1000 + randomizer.randrange(authors)),
+            "text": "benchmark tweet {}".format(i),
+            "created_at": created_at.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            "public_metrics": {
+                "like_count": randomizer.randint(0, 500),
+                "reply_count": randomizer.randint(0, 50),
+                "retweet_count": randomizer.randint(0, 100),
+                "quote_count": randomizer.randint(0, 20)
+            },
+            "entities": {"hashtags": [{"tag": "tag{}".format(randomizer.randrange(hashtags))} for tag in range(randomizer.randint(0, 3))]},
+            "attachments": {"media_keys": [media_key]}
+        })
+        media[media_key] = {"media_key": media_key, "type": "photo", "url": "https://pbs.twimg.com/media/{}.jpg".format(media_key)}
+
+    users = {str(1000 + author): {"id": str(1000 + author), "name": "Author {}".format(author), "username": "author{}".format(author)} for author in range(authors)}
+
+    return Fixture(tweets, users, media)
+
+def recorded(path):
+    '''
+        Loads recorded search-responses: a JSON-file with a list of response-bodies of the search-endpoint.
+    '''
+    with open(path) as file:
+        responses = json.load(file)
+
+    tweets, users, media = {}, {}, {}
+    for response in responses:
+        for tweet in response.get('data', []):
+            tweets[tweet['id']] = tweet
+        for user in response.get('includes', {}).get('users', []):
+            users[user['id']] = user
+        for media_element in response.get('includes', {}).get('media', []):
+            media[media_element['media_key']] = media_element
+
+    return Fixture(list(tweets.values()), users, media)
+
+def bump_metrics(fixture, share=0.5, seed=7):
+    '''
+        Increases the public metrics of a share of the tweets, like a maintenance-pull some hours later would see them.
+    '''
+    randomizer = random.Random(seed)
+    for tweet in fixture.tweets:
+        if randomizer.random() < share:
+            tweet['public_metrics']['like_count'] += randomizer.randint(1, 20)
+            tweet['public_metrics']['reply_count'] += randomizer.randint(0, 3)
+
+class FixtureServer:
+    '''
+        Replays a Fixture as Twitter's search-endpoint (since_id, until_id, max_results and next_token are supported)
+        and answers every oEmbed-request. "latency" seconds are added to every response to simulate the network.
+    '''
+    def __init__(self, fixture, latency=0.0) -> None:
+        self.fixture = fixture
+        self.latency = latency
+        self.calls = {"search": 0, "oembed": 0}
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if server.latency:
+                    time.sleep(server.latency)
+
+                if url.path == '/search':
+                    server.count('search')
+                    size = int(query.get('max_results', [PAGE_SIZE])[-1])
+                    body = server.fixture.page(query.get('since_id', [None])[0], query.get('until_id', [None])[0], int(query.get('next_token', ['0'])[0]), size)
+                    headers = {"x-rate-limit-limit": "450", "x-rate-limit-remaining": "449", "x-rate-limit-reset": str(int(time.time()) + 900)}
+                else:
+                    server.count('oembed')
+                    body = {"html": '<blockquote class="twitter-tweet"><a href="{}"></a></blockquote>'.format(query.get('url', [''])[0])}
+                    headers = {}
+
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_port)
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] += 1
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
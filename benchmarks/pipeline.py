@@ -0,0 +1,182 @@
+'''
+    Offline benchmark of the pull-pipeline: /valet, download_more_tweets, process_new_data, update_existing_data and refresh_synergy.
+    Twitter and oEmbed are replayed from fixtures (see benchmarks/fixtures.py), MongoDB is replaced by mongomock unless --mongodb-uri is given.
+    Run with: python -m benchmarks.pipeline [--sizes 1000 5000] [--fixtures recorded.json] [--mongodb-uri mongodb://localhost:27017] [--latency 0.01]
+'''
+from datetime import datetime, timedelta
+from backend import AsyncTasks, DataProcessor, Database, Executor, oembedAPI, config
+from benchmarks import fixtures
+import argparse
+import time
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+SIZES = [500, 2000, 5000]
+DATABASE = 'napoleon_benchmark'
+REQUEST_INFO = {"name": "benchmark", "user": "benchmark"}
+QUERY = 'benchmark -is:retweet has:images'
+PARAMETERS = 'max_results=100&expansions=author_id,attachments.media_keys&tweet.fields=created_at,public_metrics,entities&media.fields=url'
+
+class Result:
+    def __init__(self, scenario, size) -> None:
+        self.scenario = scenario
+        self.size = size
+        self.latencies = []
+        self.documents = 0
+
+    def measure(self, function, documents=0):
+        started = time.perf_counter()
+        function()
+        self.latencies.append(time.perf_counter() - started)
+        self.documents += documents
+
+    def percentile(self, share):
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(share * len(latencies)))]
+
+    def row(self):
+        total = sum(self.latencies)
+        return '{:<22} {:>7} {:>6} {:>9.3f} {:>10.1f} {:>9.1f} {:>9.1f}'.format(self.scenario, self.size, len(self.latencies), total,
+                                                                            self.documents / total if total else 0,
+                                                                            self.percentile(0.5) * 1000, self.percentile(0.95) * 1000)
+
+def use_backend(server, mongodb_uri, executor, max_workers):
+    '''
+        Points the backend at the fixture-server and at the benchmark-database and installs the executor for the tasks.
+    '''
+    config.twitter['tweet_search_uri'] = server.url + '/search?'
+    config.twitter['oembed'] = server.url + '/oembed?dnt=true&url='
+    config.mongodb['database'] = DATABASE
+
+    if mongodb_uri:
+        config.mongodb['uri'] = mongodb_uri
+    else:
+        if mongomock is None:
+            raise SystemExit('mongomock is not installed. Install it (pip install mongomock) or pass --mongodb-uri of a local MongoDB.')
+        if executor == 'process':
+            raise SystemExit('The process-executor needs a MongoDB that all processes share, please pass --mongodb-uri.')
+
+        client = mongomock.MongoClient()
+        Database.MongoClient = lambda *args, **kwargs: client
+
+    Database._clients.clear()
+    Executor.set_executor(Executor.create_executor(executor, max_workers))
+
+def fresh_database(saved_request=None):
+    client = Database.get_client(config.mongodb)
+    client.drop_database(DATABASE)
+    database = client[DATABASE]
+    Database.ensure_indexes(database, config.mongodb)
+    # every scenario starts with a cold oEmbed-cache
+    oembedAPI._cache = None
+
+    if saved_request:
+        database[config.mongodb['request_collection']].insert_one(dict(saved_request))
+
+    return database
+
+def saved_request(size):
+    return dict(REQUEST_INFO, query=QUERY, parameters=PARAMETERS, since_id='', last_pull=datetime.now() - timedelta(days=1),
+                maintenance_delta=7 * 24, max_results=size + 1, kill_download=False, FirstRunCompleted=False)
+
+def join():
+    Executor.get_executor().join()
+
+def bench_process_new_data(fixture, size):
+    result = Result('process_new_data', size)
+    fresh_database()
+    for page in fixture.pages():
+        result.measure(lambda: (DataProcessor.process_new_data(dict(REQUEST_INFO), page, config.mongodb), join()), page['meta']['result_count'])
+
+    return result
+
+def bench_update_existing_data(fixture, size):
+    # runs on the tweets written by bench_process_new_data()
+    result = Result('update_existing_data', size)
+    fixtures.bump_metrics(fixture)
+    for page in fixture.pages():
+        result.measure(lambda: DataProcessor.update_existing_data(page, dict(REQUEST_INFO), config.mongodb, trigger_refresh=False), page['meta']['result_count'])
+
+    return result
+
+def bench_refresh_synergy(fixture, size, repeat=3):
+    result = Result('refresh_synergy', size)
+    for i in range(repeat):
+        result.measure(lambda: AsyncTasks.refresh_synergy.sync(dict(REQUEST_INFO), config.mongodb, full_refresh=True), len(fixture.tweets))
+
+    return result
+
+def bench_download_more_tweets(fixture, size):
+    result = Result('download_more_tweets', size)
+    fresh_database(saved_request(size))
+
+    def download():
+        AsyncTasks.download_more_tweets.sync(dict(REQUEST_INFO), config.twitter['bearer'], config.twitter['tweet_search_uri'], QUERY, PARAMETERS,
+                                             api_since_tweet_id='', api_next_token=None, api_tweet_count=0, tweet_action='new')
+        join()
+
+    result.measure(download, len(fixture.tweets))
+    return result
+
+def bench_valet(fixture, size):
+    import app
+    client = app.app.test_client()
+
+    def pull():
+        response = client.post('/valet', json=dict(REQUEST_INFO, **{'async': False}))
+        assert response.get_json()['success'], response.get_json()
+        join()
+
+    new = Result('valet (new)', size)
+    fresh_database(saved_request(size))
+    new.measure(pull, len(fixture.tweets))
+
+    # the 2nd pull finds no new tweets and maintains all tweets of the 1st pull
+    maintenance = Result('valet (maintenance)', size)
+    fixtures.bump_metrics(fixture)
+    maintenance.measure(pull, len(fixture.tweets))
+
+    return [new, maintenance]
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the pull-pipeline.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='numbers of synthetic tweets')
+    parser.add_argument('--fixtures', help='JSON-file with recorded search-responses, replaces the synthetic tweets')
+    parser.add_argument('--mongodb-uri', help='local MongoDB instead of mongomock, the database "{}" is dropped'.format(DATABASE))
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response of the fixture-server')
+    parser.add_argument('--executor', default='thread', help='executor for the tasks: inline, thread or process')
+    parser.add_argument('--max-workers', type=int, default=4)
+    args = parser.parse_args()
+
+    if args.fixtures:
+        recorded = fixtures.recorded(args.fixtures)
+        loads = [(len(recorded.tweets), lambda: fixtures.recorded(args.fixtures))]
+    else:
+        loads = [(size, lambda size=size: fixtures.synthetic(size)) for size in args.sizes]
+
+    print('{:<22} {:>7} {:>6} {:>9} {:>10} {:>9} {:>9}'.format('scenario', 'tweets', 'calls', 'total [s]', 'tweets/s', 'p50 [ms]', 'p95 [ms]'))
+    for size, load in loads:
+        server = fixtures.FixtureServer(load(), args.latency).start()
+        try:
+            use_backend(server, args.mongodb_uri, args.executor, args.max_workers)
+
+            results = [bench_process_new_data(server.fixture, size),
+                       bench_update_existing_data(server.fixture, size),
+                       bench_refresh_synergy(server.fixture, size)]
+
+            server.fixture = load()
+            results.append(bench_download_more_tweets(server.fixture, size))
+
+            server.fixture = load()
+            results += bench_valet(server.fixture, size)
+
+            for result in results:
+                print(result.row())
+        finally:
+            server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+'''
+    Micro-benchmark of the scalar and the batch scoring functions in DataProcessor.
+    Run with: python -m benchmarks.scoring
+'''
+from datetime import datetime, timedelta
+from backend import DataProcessor
+import random
+import time
+
+SIZES = [1000, 10000, 100000]
+
+def make_tweets(count, seed=42):
+    randomizer = random.Random(seed)
+    now = datetime.utcnow()
+    tweets = []
+    for i in range(count):
+        created_at = now - timedelta(seconds=randomizer.randint(0, 7 * 24 * 3600), milliseconds=randomizer.randint(0, 999))
+        tweets.append({
+            "id": str(1400000000000000000 + i),
+            "created_at": created_at.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(created_at.microsecond // 1000),
+            "public_metrics": {
+                "like_count": randomizer.randint(0, 500),
+                "reply_count": randomizer.randint(0, 50),
+                "retweet_count": randomizer.randint(0, 100),
+                "quote_count": randomizer.randint(0, 20)
+            }
+        })
+
+    return tweets
+
+def measure(function):
+    started = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - started
+
+def main():
+    if DataProcessor.numpy is None:
+        print('numpy is not installed, the batch-functions fall back to the scalar functions.')
+
+    print('{:>8} {:>12} {:>12} {:>9}'.format('tweets', 'scalar [s]', 'batch [s]', 'speedup'))
+    for size in SIZES:
+        tweets = make_tweets(size)
+        now = datetime.now()
+
+        scalar, scalar_time = measure(lambda: [(DataProcessor.calc_tweet_score(tweet), DataProcessor.calc_synergy(tweet, now)) for tweet in tweets])
+        batch, batch_time = measure(lambda: (DataProcessor.calc_tweet_scores(tweets), DataProcessor.calc_synergies(tweets, now)))
+
+        assert [score for score, synergy in scalar] == list(batch[0]), 'tweet_scores differ'
+        assert [synergy for score, synergy in scalar] == list(batch[1]), 'synergies differ'
+
+        print('{:>8} {:>12.4f} {:>12.4f} {:>8.1f}x'.format(size, scalar_time, batch_time, scalar_time / batch_time))
+
+if __name__ == '__main__':
+    main()
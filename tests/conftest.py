@@ -0,0 +1,4 @@
+from benchmarks import use_config_template
+
+# the tests run without the deployment-config backend/config.py
+use_config_template()
@@ -0,0 +1,100 @@
+'''
+    DataProcessor.synergy_expression() has to return the same synergy as the reference implementation DataProcessor.calc_synergy().
+    test_synergy_expression_follows_calc_synergy() evaluates the expression in Python and runs without MongoDB.
+    test_synergy_expression_matches_calc_synergy() lets a real MongoDB evaluate it: set NAPOLEON_TEST_MONGODB_URI, the default is a local mongod.
+    That test is skipped when pymongo is missing or no MongoDB is reachable, so a run without mongod only covers the Python evaluation.
+'''
+from datetime import datetime, timedelta
+import os
+import uuid
+import pytest
+
+from backend import DataProcessor
+from benchmarks.scoring import make_tweets
+
+MONGODB_URI = os.environ.get('NAPOLEON_TEST_MONGODB_URI', 'mongodb://localhost:27017')
+
+def sample_tweets(count=500):
+    tweets = make_tweets(count)
+    # the conditions of calc_synergy() need metrics that are 0
+    for tweet in tweets[::3]:
+        tweet['public_metrics'].update(like_count=0, reply_count=0, quote_count=0)
+
+    # a tweet without public metrics has the synergy 0
+    tweets.append({"id": str(int(tweets[-1]['id']) + 1), "created_at": tweets[0]['created_at']})
+    return tweets
+
+def rounded_now():
+    # MongoDB stores dates in milliseconds, both sides calculate with the same rounded "now" (see AsyncTasks.recalculate_synergy())
+    now = datetime.now()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+def evaluate(expression, document):
+    # the operators of synergy_expression() with the semantics of MongoDB, dates are subtracted in milliseconds
+    if isinstance(expression, str) and expression.startswith('$'):
+        value = document
+        for field in expression[1:].split('.'):
+            value = value.get(field) if isinstance(value, dict) else None
+        return value
+
+    if not isinstance(expression, dict):
+        return expression
+
+    (operator, arguments), = expression.items()
+    if operator == '$dateFromString':
+        return datetime.strptime(evaluate(arguments['dateString'], document), '%Y-%m-%dT%H:%M:%S.%fZ')
+    if operator == '$cond':
+        condition, then, otherwise = arguments
+        return evaluate(then if evaluate(condition, document) else otherwise, document)
+
+    values = [evaluate(argument, document) for argument in arguments]
+    if operator == '$ifNull':
+        return values[0] if values[0] is not None else values[1]
+    if operator == '$eq':
+        return values[0] == values[1]
+    if operator == '$gt':
+        return values[0] > values[1]
+    if operator == '$add':
+        return sum(values)
+    if operator == '$multiply':
+        return values[0] * values[1]
+    if operator == '$divide':
+        return values[0] / values[1]
+    if operator == '$subtract':
+        if isinstance(values[0], datetime):
+            return (values[0] - values[1]) // timedelta(milliseconds=1)
+        return values[0] - values[1]
+
+    raise NotImplementedError(operator)
+
+def test_synergy_expression_follows_calc_synergy():
+    now = rounded_now()
+    expression = DataProcessor.synergy_expression(now)
+    for tweet in sample_tweets():
+        assert evaluate(expression, tweet) == DataProcessor.calc_synergy(tweet, now), tweet
+
+@pytest.fixture(scope='module')
+def collection():
+    pymongo = pytest.importorskip('pymongo')
+    client = pymongo.MongoClient(MONGODB_URI, serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command('ping')
+    except pymongo.errors.PyMongoError:
+        pytest.skip('no MongoDB at {}'.format(MONGODB_URI))
+
+    database = client['napoleon_test_' + uuid.uuid4().hex[:8]]
+    yield database['tweets']
+
+    client.drop_database(database.name)
+    client.close()
+
+def test_synergy_expression_matches_calc_synergy(collection):
+    tweets = sample_tweets()
+    collection.insert_many([dict(tweet) for tweet in tweets])
+
+    now = rounded_now()
+    collection.update_many({}, [{"$set": {"synergy": DataProcessor.synergy_expression(now)}}])
+
+    stored = {tweet['id']: tweet['synergy'] for tweet in collection.find({}, projection={'_id': False, 'id': True, 'synergy': True})}
+    for tweet in tweets:
+        assert stored[tweet['id']] == DataProcessor.calc_synergy(tweet, now), tweet
@@ -0,0 +1,56 @@
+'''
+    Retention.plan_batch() only compacts or archives a tweet when it expired for every request that shares it.
+'''
+from datetime import datetime
+from backend import Retention
+
+NOW = datetime(2021, 6, 30)
+EXPIRED = '2021-04-01T12:00:00.000Z'
+EXPIRED_FOR_30_DAYS = '2021-05-15T12:00:00.000Z'
+
+def make_policy(mode, after_days, compact_fields=('tweet_html', 'author')):
+    return Retention.policy({'retention': {'enabled': True, 'mode': mode, 'after_days': after_days, 'compact_fields': list(compact_fields)}})
+
+POLICIES = {
+    'archiver': make_policy('archive', 30),
+    'keeper': make_policy('slim', 60),
+    'slimmer': make_policy('slim', 30, ('author', 'media')),
+    'opted_out': Retention.policy({'retention': {'enabled': False}})
+}
+
+def tweet(tweet_id, requests, created_at):
+    return {'id': tweet_id, 'requests': requests, 'created_at': created_at}
+
+def test_tweet_of_one_request_follows_its_policy():
+    archived = tweet('1', ['archiver'], EXPIRED_FOR_30_DAYS)
+    assert Retention.plan_batch([archived], 'archiver', POLICIES, NOW)['archive'] == [archived]
+    assert Retention.plan_batch([tweet('2', ['slimmer'], EXPIRED_FOR_30_DAYS)], 'slimmer', POLICIES, NOW)['compact'] == {('author', 'media'): ['2']}
+
+def test_shared_tweet_is_kept_while_another_request_keeps_it():
+    shared = tweet('1', ['archiver', 'keeper'], EXPIRED_FOR_30_DAYS)
+
+    plan = Retention.plan_batch([shared], 'archiver', POLICIES, NOW)
+    assert plan['release'] == {'archiver': ['1']}
+    assert (plan['archive'], plan['compact'], plan['retain']) == ([], {}, [])
+
+    plan = Retention.plan_batch([tweet('2', ['slimmer', 'keeper'], EXPIRED_FOR_30_DAYS)], 'slimmer', POLICIES, NOW)
+    assert plan['retain'] == ['2']
+    assert (plan['archive'], plan['compact'], plan['release']) == ([], {}, {})
+
+def test_retention_is_off_by_default():
+    assert not Retention.policy({})['enabled']
+
+def test_request_without_retention_keeps_shared_tweet():
+    plan = Retention.plan_batch([tweet('1', ['archiver', 'opted_out'], EXPIRED)], 'archiver', POLICIES, NOW)
+    assert plan['release'] == {'archiver': ['1']}
+    assert (plan['archive'], plan['compact']) == ([], {})
+
+def test_shared_tweet_expired_for_all_requests():
+    plan = Retention.plan_batch([tweet('1', ['archiver', 'keeper'], EXPIRED)], 'archiver', POLICIES, NOW)
+    assert plan['release'] == {'archiver': ['1']}
+    assert plan['compact'] == {('author', 'tweet_html'): ['1']}
+    assert plan['archive'] == []
+
+    # only the fields that every "slim"-request compacts are removed
+    plan = Retention.plan_batch([tweet('2', ['keeper', 'slimmer'], EXPIRED)], 'keeper', POLICIES, NOW)
+    assert plan['compact'] == {('author',): ['2']}
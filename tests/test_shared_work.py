@@ -0,0 +1,29 @@
+'''
+    The claims of a batch are stored in MongoDB, so a task in another process (another SharedWork on the same batch) sees them.
+    MongoDB is replaced by mongomock, the test is skipped without it.
+'''
+import pytest
+from backend import SharedWork
+
+mongomock = pytest.importorskip('mongomock')
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient().napoleon_test.shared_work
+
+def test_first_request_of_the_batch_owns_the_document(collection):
+    batch = SharedWork.SharedWork('batch', collection)
+    assert batch.claim_many('tweet', ['1', '2'], 'first') == {'1', '2'}
+    assert batch.claim_many('tweet', ['2', '3'], 'second') == {'3'}
+    assert batch.claim_many('tweet', ['1', '2', '3'], 'first') == {'1', '2'}
+    assert batch.claim('user', '1', 'second')
+
+def test_claims_are_seen_by_another_process(collection):
+    SharedWork.SharedWork('batch', collection).claim_many('tweet', ['1', '2'], 'first')
+    other_process = SharedWork.SharedWork('batch', collection)
+    assert other_process.claim_many('tweet', ['1', '2', '3'], 'second') == {'3'}
+    assert other_process.claim_many('tweet', ['1'], 'first') == {'1'}
+
+def test_batches_dont_share_claims(collection):
+    SharedWork.SharedWork('batch', collection).claim_many('tweet', ['1'], 'first')
+    assert SharedWork.SharedWork('next_batch', collection).claim_many('tweet', ['1'], 'second') == {'1'}